@@ -0,0 +1,85 @@
+"""
+Calculate the population density of every administrative area of every city in `data.config.CONFIG`.
+Each city is processed in its own worker process, which opens its own raster handle.
+Cities without configured features are skipped.
+
+Usage:
+    python batch_densities.py --data-dir ../../datasets/geospatial --output densities.csv
+"""
+import argparse
+import csv
+import logging
+import os
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+
+from data.config import CONFIG
+from utilities.cache import DEFAULT_CACHE_DIR, get_cities, get_config_polygons
+from utilities.zonal import get_density_per_area_zonal
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["country", "city", "shapeID", "shapeName", "population", "area_km2", "density"]
+
+
+def calc_city_densities(country: str, city: str, data_dir: str, cache_dir: str = DEFAULT_CACHE_DIR):
+    config = CONFIG[country]
+    raster_filepath = os.path.join(data_dir, 'rasters', config["raster filepath"])
+    polygons = get_config_polygons(config, city, data_dir, identifier='shapeID', cache_dir=cache_dir)
+    names = dict(config["features"][city])
+    with rasterio.open(raster_filepath) as src:
+        densities, population_counts, areas = get_density_per_area_zonal(src, polygons.values())
+    rows = []
+    for shape_id, density, population, area in zip(polygons.keys(), densities, population_counts, areas):
+        rows.append({
+            "country": country,
+            "city": city,
+            "shapeID": shape_id,
+            "shapeName": names.get(shape_id, ''),
+            "population": f"{population:.2f}",
+            "area_km2": f"{area/1e6:.4f}",
+            "density": f"{density:.2f}",
+        })
+    return rows
+
+
+def run(data_dir: str, output: str, workers: int = None, countries: list = None, cache_dir: str = DEFAULT_CACHE_DIR):
+    cities = get_cities(CONFIG, countries)
+    logger.info(f"Calculating densities for {len(cities)} cities.")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(calc_city_densities, country, city, data_dir, cache_dir)
+            for country, city in cities
+        ]
+        rows = []
+        for (country, city), future in zip(cities, futures):
+            try:
+                city_rows = future.result()
+            except Exception as e:
+                logger.error(f"Failed for {city}, {country}: {e}")
+                continue
+            logger.info(f"{city}, {country}: {len(city_rows)} areas.")
+            rows.extend(city_rows)
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    logger.info(f"Saved {len(rows)} rows to {output}")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=os.path.join('..', '..', 'datasets', 'geospatial'),
+                        help="Directory with the 'borders' and 'rasters' folders.")
+    parser.add_argument('--output', default='densities.csv', help="Output CSV file.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes. Defaults to the number of CPUs.")
+    parser.add_argument('--countries', nargs='*', default=None, help="Only process these countries.")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory for the geometry cache.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    run(args.data_dir, args.output, workers=args.workers, countries=args.countries, cache_dir=args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Time the hot paths of the utilities on synthetic data and compare them against a stored baseline.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --sizes small medium
+    python -m benchmarks.run_benchmarks --save-baseline
+A benchmark regresses if its time or peak memory exceeds the baseline by more than the tolerance.
+The exit code is 1 if any benchmark regressed.
+"""
+import argparse
+import json
+import logging
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import platform
+import rasterio
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic import SIZES, get_extent, make_dataset
+from utilities.area import get_density_per_area
+from utilities.geojson import convert_dict_to_shapely, filter_features_by_proximity, get_polygons, read_features
+from utilities.plotting import plot_polygons_collection, plot_polygons_transform
+from utilities.zonal import get_density_per_area_zonal
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILEPATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def measure(fn, repeats: int = 3):
+    """
+    Minimum and median wall time over `repeats` calls, and the peak memory traced during one extra call.
+    Peak memory only includes allocations made through Python, such as NumPy arrays, and not GDAL's.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time_min": min(times), "time_median": float(np.median(times)), "peak_memory": peak}
+
+
+def get_benchmarks(raster_filepath: str, geojson_filepath: str, size: str):
+    """
+    Benchmarks as (name, function) pairs for one dataset.
+    Density benchmarks use the units within a quarter of the extent of the centre, as with the proximity sets in the notebooks.
+    """
+    with open(geojson_filepath, 'r') as f:
+        shape_data = json.load(f)
+    features = shape_data['features']
+    long_min, lat_min, long_max, lat_max = get_extent(size)
+    centre = ((long_min + long_max) / 2, (lat_min + lat_max) / 2)
+    distance = (lat_max - lat_min) / 4 * np.pi / 180 * 6_371_007.2 # metres
+    near_features = filter_features_by_proximity(shape_data, centre, distance)
+    polygons = list(get_polygons(near_features, identifier='shapeID').values())
+    with rasterio.open(raster_filepath) as src:
+        transform = src.transform
+
+    def density_per_area():
+        with rasterio.open(raster_filepath) as src:
+            get_density_per_area(src, polygons)
+
+    def density_per_area_zonal():
+        with rasterio.open(raster_filepath) as src:
+            get_density_per_area_zonal(src, polygons)
+
+    def proximity():
+        filter_features_by_proximity(shape_data, centre, distance)
+
+    def read_geojson():
+        read_features(geojson_filepath, 'shapeID', [f['properties']['shapeID'] for f in near_features])
+
+    def dict_to_shapely():
+        for feature in features:
+            convert_dict_to_shapely(feature['geometry'])
+
+    def features_to_polygons():
+        get_polygons(features, identifier='shapeID')
+
+    def polygons_transform():
+        fig, ax = plt.subplots()
+        plot_polygons_transform(ax, polygons, transform.__invert__(), 'k-', linewidth=0.5)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    def polygons_collection():
+        fig, ax = plt.subplots()
+        plot_polygons_collection(ax, polygons, transform.__invert__(), color='k', linewidth=0.5)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    return [
+        ("get_density_per_area", density_per_area),
+        ("get_density_per_area_zonal", density_per_area_zonal),
+        ("filter_features_by_proximity", proximity),
+        ("read_features", read_geojson),
+        ("convert_dict_to_shapely", dict_to_shapely),
+        ("get_polygons", features_to_polygons),
+        ("plot_polygons_transform", polygons_transform),
+        ("plot_polygons_collection", polygons_collection),
+    ]
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Return the keys of results which are slower or use more memory than the baseline by more than the tolerance.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["time_min"] > base["time_min"] * (1 + tolerance):
+            regressions.append(f"{key}: time {result['time_min']:.4f}s > {base['time_min']:.4f}s")
+        if result["peak_memory"] > base["peak_memory"] * (1 + tolerance) + 2**20:
+            regressions.append(
+                f"{key}: peak memory {result['peak_memory']/2**20:.1f}MB > {base['peak_memory']/2**20:.1f}MB")
+    return regressions
+
+
+def run(sizes: list, data_dir: str, repeats: int = 3, only: list = None):
+    results = {}
+    for size in sizes:
+        logger.info(f"Generating {size} dataset in {data_dir} ...")
+        raster_filepath, geojson_filepath = make_dataset(data_dir, size)
+        for name, fn in get_benchmarks(raster_filepath, geojson_filepath, size):
+            if only and name not in only:
+                continue
+            key = f"{size}/{name}"
+            results[key] = measure(fn, repeats=repeats)
+            result = results[key]
+            print(f"{key:45s} {result['time_min']:9.4f}s  {result['time_median']:9.4f}s  {result['peak_memory']/2**20:9.1f}MB")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', nargs='*', default=['small', 'medium'], choices=list(SIZES.keys()))
+    parser.add_argument('--only', nargs='*', default=None, help="Only run these benchmarks.")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'population_benchmarks'),
+                        help="Directory for the synthetic data. Files are reused between runs.")
+    parser.add_argument('--baseline', default=BASELINE_FILEPATH)
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed fractional increase over the baseline.")
+    parser.add_argument('--output', default=None, help="Also save the results to this JSON file.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    print(f"{'benchmark':45s} {'min':>10s}  {'median':>10s}  {'peak':>11s}")
+    results = run(args.sizes, args.data_dir, repeats=args.repeats, only=args.only)
+    report = {"machine": platform.platform(), "python": platform.python_version(), "results": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        baseline = {"results": {}}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+        baseline.update({"machine": report["machine"], "python": report["python"]})
+        baseline["results"].update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        logger.info(f"Saved baseline to {args.baseline}")
+        return 0
+    if not os.path.isfile(args.baseline):
+        logger.warning(f"No baseline at {args.baseline}. Run with --save-baseline to create one.")
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+        logger.error(f"Regression: {regression}")
+    if not regressions:
+        logger.info("No regressions against the baseline.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
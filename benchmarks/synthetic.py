@@ -0,0 +1,138 @@
+"""
+Synthetic WorldPop-like rasters and geoBoundaries-like GeoJSON files for benchmarking.
+Everything is generated offline from a seed so runs are repeatable.
+"""
+import json
+import numpy as np
+import os
+import rasterio
+from rasterio.transform import from_origin
+
+PIXEL_SIZE = 3 / 3600 # degrees. 3 arcseconds as in WorldPop
+NODATA = -99999
+
+SIZES = {
+    # raster pixels per side, admin units per side, vertices per unit edge
+    "small": {"pixels": 1200, "units": 20, "edge_vertices": 20},
+    "medium": {"pixels": 3000, "units": 50, "edge_vertices": 40},
+    "large": {"pixels": 6000, "units": 100, "edge_vertices": 80},
+}
+
+
+def get_extent(size: str, long_min: float = 30.0, lat_min: float = -26.5):
+    pixels = SIZES[size]["pixels"]
+    return long_min, lat_min, long_min + pixels * PIXEL_SIZE, lat_min + pixels * PIXEL_SIZE
+
+
+def make_population_raster(filepath: str, size: str, seed: int = 0, long_min: float = 30.0, lat_min: float = -26.5):
+    """
+    Write a float32 GeoTIFF with a dense centre, gamma distributed noise and unpopulated (nodata) pixels.
+    The file is tiled and compressed like the WorldPop rasters.
+    """
+    pixels = SIZES[size]["pixels"]
+    rng = np.random.default_rng(seed)
+    profile = {
+        'driver': 'GTiff',
+        'height': pixels,
+        'width': pixels,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': 'EPSG:4326',
+        'transform': from_origin(long_min, lat_min + pixels * PIXEL_SIZE, PIXEL_SIZE, PIXEL_SIZE),
+        'nodata': NODATA,
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'lzw',
+    }
+    strip_height = 512
+    cols = np.arange(pixels)
+    with rasterio.open(filepath, 'w', **profile) as dst:
+        for row_start in range(0, pixels, strip_height):
+            height = min(strip_height, pixels - row_start)
+            rows = np.arange(row_start, row_start + height)[:, np.newaxis]
+            distance = np.hypot(rows - pixels / 2, cols - pixels / 2) / pixels
+            scale = 200 * np.exp(-(distance / 0.15) ** 2) + 2
+            strip = rng.gamma(0.8, scale).astype(np.float32)
+            strip[rng.random(strip.shape) < 0.3] = NODATA
+            dst.write(strip, 1, window=rasterio.windows.Window(0, row_start, pixels, height))
+    return filepath
+
+
+def make_admin_geojson(filepath: str, size: str, seed: int = 0, long_min: float = 30.0, lat_min: float = -26.5):
+    """
+    Write a FeatureCollection of adjacent administrative units over the raster extent.
+    The units are cells of a jittered grid with densified edges. Every tenth unit has a hole
+    and every seventh is a MultiPolygon with a hole and an island inside it.
+    """
+    num_units = SIZES[size]["units"]
+    edge_vertices = SIZES[size]["edge_vertices"]
+    rng = np.random.default_rng(seed)
+    _, _, long_max, lat_max = get_extent(size, long_min, lat_min)
+    step_x = (long_max - long_min) / num_units
+    step_y = (lat_max - lat_min) / num_units
+    xs = long_min + step_x * np.arange(num_units + 1)
+    ys = lat_min + step_y * np.arange(num_units + 1)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    jitter = rng.uniform(-0.25, 0.25, size=(2, num_units + 1, num_units + 1))
+    jitter[:, [0, -1], :] = 0
+    jitter[:, :, [0, -1]] = 0
+    grid_x = grid_x + jitter[0] * step_x
+    grid_y = grid_y + jitter[1] * step_y
+    t = np.linspace(0, 1, edge_vertices, endpoint=False)[:, np.newaxis]
+    square = np.array([(-1, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)])
+
+    def edge(p, q):
+        return p + t * (q - p)
+
+    features = []
+    for i in range(num_units):
+        for j in range(num_units):
+            corners = [
+                np.array((grid_x[i, j], grid_y[i, j])),
+                np.array((grid_x[i, j + 1], grid_y[i, j + 1])),
+                np.array((grid_x[i + 1, j + 1], grid_y[i + 1, j + 1])),
+                np.array((grid_x[i + 1, j], grid_y[i + 1, j])),
+            ]
+            ring = np.concatenate([edge(corners[k], corners[(k + 1) % 4]) for k in range(4)])
+            ring = np.vstack([ring, ring[:1]])
+            idx = i * num_units + j
+            centre = np.mean(corners, axis=0)
+            hole = centre + square * (step_x * 0.05, step_y * 0.05)
+            island = centre + square * (step_x * 0.01, step_y * 0.01)
+            if idx % 7 == 0:
+                geometry = {"type": "MultiPolygon", "coordinates": [
+                    [ring.tolist(), hole.tolist()], [island.tolist()]
+                ]}
+            elif idx % 10 == 0:
+                geometry = {"type": "Polygon", "coordinates": [ring.tolist(), hole.tolist()]}
+            else:
+                geometry = {"type": "Polygon", "coordinates": [ring.tolist()]}
+            features.append({
+                "type": "Feature",
+                "properties": {
+                    "shapeName": f"Unit {idx}",
+                    "shapeISO": "",
+                    "shapeID": f"SYN{seed:02d}B{idx:08d}",
+                    "shapeGroup": "SYN",
+                    "shapeType": "ADM3",
+                },
+                "geometry": geometry,
+            })
+    with open(filepath, 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    return filepath
+
+
+def make_dataset(data_dir: str, size: str, seed: int = 0):
+    """
+    Create (or reuse) the raster and GeoJSON files for a size. Returns their file paths.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    raster_filepath = os.path.join(data_dir, f"synthetic_{size}_{seed}.tif")
+    geojson_filepath = os.path.join(data_dir, f"synthetic_{size}_{seed}.geojson")
+    if not os.path.isfile(raster_filepath):
+        make_population_raster(raster_filepath, size, seed=seed)
+    if not os.path.isfile(geojson_filepath):
+        make_admin_geojson(geojson_filepath, size, seed=seed)
+    return raster_filepath, geojson_filepath
@@ -0,0 +1,73 @@
+"""
+Build count-preserving overview pyramids next to the population rasters of `data.config.CONFIG`.
+Each raster is processed in its own worker process. Up to date overviews are skipped unless `--force` is given.
+
+Usage:
+    python build_overviews.py --data-dir ../../datasets/geospatial --max-factor 64
+"""
+import argparse
+import logging
+import os
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+
+from data.config import CONFIG
+from utilities.overviews import build_overviews, get_level_factors, get_overview_factors
+
+logger = logging.getLogger(__name__)
+
+
+def build_raster_overviews(raster_filepath: str, max_factor: int = 64, force: bool = False):
+    """
+    Build the overviews of a raster unless every level `build_overviews` would build for it exists and is up to date.
+    """
+    if not force:
+        with rasterio.open(raster_filepath) as src:
+            expected = get_level_factors(src.width, src.height, max_factor=max_factor)
+        if set(expected) <= set(get_overview_factors(raster_filepath)):
+            logger.info(f"Overviews of {raster_filepath} are up to date.")
+            return []
+    return build_overviews(raster_filepath, max_factor=max_factor)
+
+
+def get_raster_filepaths(data_dir: str, countries: list = None):
+    filepaths = []
+    for country, config in CONFIG.items():
+        if countries and country not in countries:
+            continue
+        filepath = os.path.join(data_dir, 'rasters', config["raster filepath"])
+        if filepath not in filepaths:
+            filepaths.append(filepath)
+    return filepaths
+
+
+def run(data_dir: str, max_factor: int = 64, workers: int = None, countries: list = None, force: bool = False):
+    filepaths = get_raster_filepaths(data_dir, countries)
+    logger.info(f"Building overviews for {len(filepaths)} rasters.")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_raster_overviews, filepath, max_factor, force) for filepath in filepaths]
+        for filepath, future in zip(filepaths, futures):
+            try:
+                factors = future.result()
+            except Exception as e:
+                logger.error(f"Failed for {filepath}: {e}")
+                continue
+            if factors:
+                logger.info(f"{filepath}: built levels {factors}.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=os.path.join('..', '..', 'datasets', 'geospatial'),
+                        help="Directory with the 'rasters' folder.")
+    parser.add_argument('--max-factor', type=int, default=64, help="Coarsest level to build, as a power of 2.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes. Defaults to the number of CPUs.")
+    parser.add_argument('--countries', nargs='*', default=None, help="Only process these countries.")
+    parser.add_argument('--force', action='store_true', help="Rebuild overviews which are up to date.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    run(args.data_dir, max_factor=args.max_factor, workers=args.workers, countries=args.countries, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
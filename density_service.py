@@ -0,0 +1,398 @@
+"""
+Local HTTP service answering population and density queries with the rasters of `data.config.CONFIG` kept open
+and the administrative areas of the configured cities loaded, so each query avoids the startup cost of a notebook.
+Queries for arbitrary geometries arriving together are batched into one raster read per country.
+
+Usage:
+    python density_service.py --data-dir ../../datasets/geospatial --port 8765
+
+Queries:
+    GET  /health
+    GET  /cities
+    GET  /city?country=Bangladesh&city=Dhaka
+    GET  /nearest?country=Bangladesh&long=90.4&lat=23.8&k=1
+    POST /density  {"country": "Bangladesh", "geometries": [<GeoJSON Polygon or MultiPolygon>, ...]}
+    POST /stats    {"country": "Bangladesh", "geometries": [...]}
+For example:
+    curl -X POST localhost:8765/density -d '{"country": "Bangladesh", "geometries": [{"type": "Polygon", ...}]}'
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import rasterio
+import rasterio.windows
+import shapely
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shapely import MultiPolygon, Polygon
+from typing import List, Union
+from urllib.parse import parse_qs, urlparse
+
+from data.config import CONFIG
+from utilities.area import calc_geometry_areas
+from utilities.cache import DEFAULT_CACHE_DIR, get_cities, get_config_polygons
+from utilities.geojson import convert_dict_to_shapely, read_features
+from utilities.raster import BlockReader
+from utilities.spatial_index import FeatureIndex
+from utilities.zonal import ZoneWeights
+
+logger = logging.getLogger(__name__)
+
+
+def get_density(population: float, area: float):
+    """
+    People/km^2 for an area in metres^2, or None for a zero area since JSON has no NaN.
+    """
+    return float(population / (area/1e6)) if area > 0 else None
+
+
+class DensityService:
+    """
+    Resident rasters, city geometries and zone weights, with a single thread doing all raster reads.
+    Requests for arbitrary geometries are queued. The reader thread waits `batch_delay` seconds for more requests,
+    groups them by country into batches whose combined window has at most `max_batch_pixels` pixels,
+    and answers each batch with one `ZoneWeights` read.
+    Queries wait at most `request_timeout` seconds for the reader thread before raising a `TimeoutError`.
+    """
+    def __init__(
+            self,
+            data_dir: str,
+            countries: list = None,
+            cache_dir: str = DEFAULT_CACHE_DIR,
+            batch_delay: float = 0.005,
+            max_batch_pixels: int = 2**24,
+            request_timeout: float = 60.0,
+        ):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.batch_delay = batch_delay
+        self.max_batch_pixels = max_batch_pixels
+        self.request_timeout = request_timeout
+        self.rasters = {}
+        self.cities = {}
+        self.indexes = {}
+        self._index_lock = threading.Lock()
+        self._queue = queue.Queue()
+        for country, city in get_cities(CONFIG, countries):
+            try:
+                self._load_city(country, city)
+            except Exception as e:
+                logger.error(f"Failed to load {city}, {country}: {e}")
+        self._reader = threading.Thread(target=self._run, name="density-reader", daemon=True)
+        self._reader.start()
+
+    def _load_city(self, country: str, city: str):
+        config = CONFIG[country]
+        if country not in self.rasters:
+            raster_filepath = os.path.join(self.data_dir, 'rasters', config["raster filepath"])
+            self.rasters[country] = BlockReader(rasterio.open(raster_filepath))
+        polygons = get_config_polygons(config, city, self.data_dir, identifier='shapeID', cache_dir=self.cache_dir)
+        shapes = list(polygons.values())
+        self.cities[(country, city)] = {
+            "ids": list(polygons.keys()),
+            "names": dict(config["features"][city]),
+            "areas": calc_geometry_areas(shapes, holes=False),
+            "weights": ZoneWeights.from_shapes(self.rasters[country], shapes),
+        }
+        logger.info(f"Loaded {len(shapes)} areas of {city}, {country}.")
+
+    def get_index(self, country: str) -> FeatureIndex:
+        """
+        Index of all the country's administrative areas, built on first use.
+        """
+        with self._index_lock:
+            if country not in self.indexes:
+                geojson_filepath = os.path.join(self.data_dir, 'borders', CONFIG[country]["geojson filepath"])
+                self.indexes[country] = FeatureIndex({'features': read_features(geojson_filepath)})
+            return self.indexes[country]
+
+    # -------------------------------------------#
+    #               Reader thread
+    # -------------------------------------------#
+
+    def _submit(self, job: tuple) -> Future:
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def _result(self, future: Future):
+        try:
+            return future.result(timeout=self.request_timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"No answer from the reader thread after {self.request_timeout} seconds")
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()] + self._drain()
+            try:
+                self._answer(items)
+            except Exception as e:
+                # keep the thread alive and fail whatever was not answered
+                logger.exception("Reader thread failed to answer a batch")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _answer(self, items: list):
+        batches = {}
+        for job, future in items:
+            if job[0] == "call":
+                self._resolve(future, job[1])
+            else:
+                _, country, shapes = job
+                batches.setdefault(country, []).append((shapes, future))
+        for country, requests in batches.items():
+            for batch in self._split_batches(country, requests):
+                self._reduce_batch(country, batch)
+
+    def _drain(self):
+        items = []
+        try:
+            items.append(self._queue.get(timeout=self.batch_delay))
+            while True:
+                items.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
+    @staticmethod
+    def _resolve(future: Future, fn):
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _split_batches(self, country: str, requests: list):
+        """
+        Greedily group requests while the window covering all their shapes stays within `max_batch_pixels`.
+        """
+        raster = self.rasters[country]
+        batches = []
+        batch, batch_bounds = [], None
+        for shapes, future in requests:
+            bounds = shapely.total_bounds(shapes)
+            if batch:
+                merged = (min(bounds[0], batch_bounds[0]), min(bounds[1], batch_bounds[1]),
+                          max(bounds[2], batch_bounds[2]), max(bounds[3], batch_bounds[3]))
+                window = rasterio.windows.from_bounds(*merged, transform=raster.transform)
+                if window.width * window.height <= self.max_batch_pixels:
+                    batch.append((shapes, future))
+                    batch_bounds = merged
+                    continue
+                batches.append(batch)
+            batch, batch_bounds = [(shapes, future)], bounds
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _reduce_batch(self, country: str, batch: list):
+        """
+        Answer the requests of a batch with one read. If that fails, each request is retried on its own
+        so that one bad request does not fail the others.
+        """
+        raster = self.rasters[country]
+        try:
+            shapes = [shape for request_shapes, _ in batch for shape in request_shapes]
+            sums, maxs, _ = ZoneWeights.from_shapes(raster, shapes).zonal_stats(raster)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            logger.warning(f"Batch of {len(batch)} requests for {country} failed, retrying separately: {e}")
+            for request_shapes, future in batch:
+                self._resolve(future, lambda: ZoneWeights.from_shapes(raster, request_shapes).zonal_stats(raster)[:2])
+            return
+        start = 0
+        for request_shapes, future in batch:
+            stop = start + len(request_shapes)
+            future.set_result((sums[start:stop], maxs[start:stop]))
+            start = stop
+        logger.debug(f"Answered {len(batch)} requests for {country} with {len(shapes)} shapes in one read.")
+
+    # -------------------------------------------#
+    #                  Queries
+    # -------------------------------------------#
+
+    def _check_country(self, country: str):
+        if country not in self.rasters:
+            raise ValueError(f"Country '{country}' is not loaded")
+
+    @staticmethod
+    def _check_shapes(shapes: List[Union[Polygon, MultiPolygon]]):
+        for idx, shape in enumerate(shapes):
+            if not isinstance(shape, (Polygon, MultiPolygon)):
+                raise ValueError(f"Geometry {idx} of type {shape.geom_type} is not supported")
+            if shape.is_empty:
+                raise ValueError(f"Geometry {idx} is empty")
+
+    def get_densities(self, country: str, shapes: List[Union[Polygon, MultiPolygon]]) -> List[dict]:
+        """
+        Same values as `get_density_per_area` for each shape.
+        """
+        self._check_country(country)
+        self._check_shapes(shapes)
+        if not shapes:
+            return []
+        areas = calc_geometry_areas(shapes, holes=False)
+        sums, maxs = self._result(self._submit(("shapes", country, shapes)))
+        return [
+            {"population": float(p), "max": float(m), "area_km2": float(a/1e6), "density": get_density(p, a)}
+            for p, m, a in zip(sums, maxs, areas)
+        ]
+
+    def get_stats(self, country: str, shapes: List[Union[Polygon, MultiPolygon]]) -> dict:
+        """
+        Same values as `show_stats` for the union of the shapes.
+        """
+        self._check_country(country)
+        self._check_shapes(shapes)
+        if not shapes:
+            raise ValueError("Expected at least one geometry")
+        union = shapely.union_all(shapes)
+        area = calc_geometry_areas(shapes, holes=False).sum()
+        sums, maxs = self._result(self._submit(("shapes", country, [union])))
+        return {
+            "population": float(sums[0]), "max": float(maxs[0]),
+            "area_km2": float(area/1e6), "density": get_density(sums[0], area),
+        }
+
+    def get_city(self, country: str, city: str) -> List[dict]:
+        """
+        Densities of a configured city's administrative areas from its precomputed zone weights.
+        """
+        if (country, city) not in self.cities:
+            raise ValueError(f"City '{city}, {country}' is not loaded")
+        entry = self.cities[(country, city)]
+        raster = self.rasters[country]
+        sums, maxs, _ = self._result(self._submit(("call", lambda: entry["weights"].zonal_stats(raster))))
+        return [
+            {
+                "shapeID": shape_id, "shapeName": entry["names"].get(shape_id, ''),
+                "population": float(p), "max": float(m), "area_km2": float(a/1e6), "density": get_density(p, a),
+            }
+            for shape_id, p, m, a in zip(entry["ids"], sums, maxs, entry["areas"])
+        ]
+
+    def get_nearest(self, country: str, point: tuple, k: int = 1) -> List[dict]:
+        """
+        The `k` administrative areas of the country nearest the point, with their densities.
+        """
+        self._check_country(country)
+        features = self.get_index(country).nearest(point, k=k)
+        shapes = [convert_dict_to_shapely(feature['geometry']) for feature in features]
+        results = self.get_densities(country, shapes) if shapes else []
+        for feature, result in zip(features, results):
+            result.update({key: feature['properties'].get(key) for key in ('shapeID', 'shapeName')})
+        return results
+
+
+# -------------------------------------------#
+#                HTTP server
+# -------------------------------------------#
+
+
+def parse_geometries(body: dict) -> List[Union[Polygon, MultiPolygon]]:
+    """
+    Shapes from a request with a list of GeoJSON "geometries", a single "geometry" or a list of "features".
+    """
+    if "geometries" in body:
+        geometries = body["geometries"]
+    elif "geometry" in body:
+        geometries = [body["geometry"]]
+    elif "features" in body:
+        geometries = [feature["geometry"] for feature in body["features"]]
+    else:
+        raise ValueError("Expected 'geometries', 'geometry' or 'features'")
+    return [convert_dict_to_shapely(geometry) for geometry in geometries]
+
+
+def make_handler(service: DensityService):
+    class DensityRequestHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, fn):
+            try:
+                self._send(200, fn())
+            except (KeyError, ValueError, TypeError) as e:
+                self._send(400, {"error": str(e)})
+            except TimeoutError as e:
+                logger.error(f"Timed out answering {self.path}")
+                self._send(504, {"error": str(e)})
+            except Exception as e:
+                logger.exception(f"Failed to answer {self.path}")
+                self._send(500, {"error": str(e)})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/health':
+                self._handle(lambda: {"status": "ok", "countries": sorted(service.rasters)})
+            elif url.path == '/cities':
+                self._handle(lambda: [{"country": country, "city": city} for country, city in service.cities])
+            elif url.path == '/city':
+                self._handle(lambda: service.get_city(params['country'], params['city']))
+            elif url.path == '/nearest':
+                self._handle(lambda: service.get_nearest(
+                    params['country'], (float(params['long']), float(params['lat'])), k=int(params.get('k', 1))))
+            else:
+                self._send(404, {"error": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length', 0))
+
+            def answer(fn):
+                body = json.loads(self.rfile.read(length) or b'{}')
+                return fn(body["country"], parse_geometries(body))
+
+            if url.path == '/density':
+                self._handle(lambda: answer(service.get_densities))
+            elif url.path == '/stats':
+                self._handle(lambda: answer(service.get_stats))
+            else:
+                self._send(404, {"error": f"Unknown path {url.path}"})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return DensityRequestHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=os.path.join('..', '..', 'datasets', 'geospatial'),
+                        help="Directory with the 'borders' and 'rasters' folders.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--countries', nargs='*', default=None, help="Only load these countries.")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory for the geometry cache.")
+    parser.add_argument('--batch-delay', type=float, default=0.005, help="Seconds to wait for requests to batch.")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Seconds a request waits for the raster reader.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    service = DensityService(
+        args.data_dir, countries=args.countries, cache_dir=args.cache_dir,
+        batch_delay=args.batch_delay, request_timeout=args.timeout,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    logger.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Cumulative population and density against distance from the centre of every city in `data.config.CONFIG`.
+The centre of a city is the centroid of its configured administrative areas.
+Each city is processed in its own worker process.
+
+Usage:
+    python radial_profiles.py --data-dir ../../datasets/geospatial --max-distance 50 --ring-width 1 --output profiles.csv
+"""
+import argparse
+import csv
+import logging
+import os
+import rasterio
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+
+from data.config import CONFIG
+from utilities.area import get_radial_profile
+from utilities.cache import DEFAULT_CACHE_DIR, get_cities, get_config_polygons
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["country", "city", "radius_km", "population", "area_km2", "density"]
+
+
+def calc_city_profile(
+        country: str,
+        city: str,
+        data_dir: str,
+        max_distance: float = 50e3,
+        ring_width: float = 1e3,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+    ):
+    config = CONFIG[country]
+    raster_filepath = os.path.join(data_dir, 'rasters', config["raster filepath"])
+    polygons = get_config_polygons(config, city, data_dir, identifier='shapeID', cache_dir=cache_dir)
+    centroid = shapely.unary_union(list(polygons.values())).centroid
+    with rasterio.open(raster_filepath) as src:
+        radii, densities, population_counts, areas = get_radial_profile(
+            src, (centroid.x, centroid.y), max_distance, ring_width=ring_width)
+    rows = []
+    for radius, density, population, area in zip(radii, densities, population_counts, areas):
+        rows.append({
+            "country": country,
+            "city": city,
+            "radius_km": f"{radius/1e3:g}",
+            "population": f"{population:.2f}",
+            "area_km2": f"{area/1e6:.4f}",
+            "density": f"{density:.2f}",
+        })
+    return rows
+
+
+def run(
+        data_dir: str,
+        output: str,
+        max_distance: float = 50e3,
+        ring_width: float = 1e3,
+        workers: int = None,
+        countries: list = None,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+    ):
+    cities = get_cities(CONFIG, countries)
+    logger.info(f"Calculating radial profiles for {len(cities)} cities.")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(calc_city_profile, country, city, data_dir, max_distance, ring_width, cache_dir)
+            for country, city in cities
+        ]
+        rows = []
+        for (country, city), future in zip(cities, futures):
+            try:
+                rows.extend(future.result())
+            except Exception as e:
+                logger.error(f"Failed for {city}, {country}: {e}")
+                continue
+            logger.info(f"Calculated profile for {city}, {country}.")
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    logger.info(f"Saved {len(rows)} rows to {output}")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=os.path.join('..', '..', 'datasets', 'geospatial'),
+                        help="Directory with the 'borders' and 'rasters' folders.")
+    parser.add_argument('--output', default='profiles.csv', help="Output CSV file.")
+    parser.add_argument('--max-distance', type=float, default=50, help="Largest radius in km.")
+    parser.add_argument('--ring-width', type=float, default=1, help="Step between radii in km.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes. Defaults to the number of CPUs.")
+    parser.add_argument('--countries', nargs='*', default=None, help="Only process these countries.")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory for the geometry cache.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    run(
+        args.data_dir, args.output, max_distance=args.max_distance * 1e3, ring_width=args.ring_width * 1e3,
+        workers=args.workers, countries=args.countries, cache_dir=args.cache_dir,
+    )
+
+
+if __name__ == '__main__':
+    main()
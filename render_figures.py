@@ -0,0 +1,294 @@
+"""
+Render the group population distribution and density figures without a notebook.
+The data for each city's panel is prepared in parallel and the figures are composed at the end.
+
+Usage:
+    python render_figures.py --data-dir ../../datasets/geospatial --output-dir images
+"""
+import argparse
+import logging
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import rasterio
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from shapely import Polygon, box
+from typing import List
+
+from data.config import CONFIG
+from utilities.area import EARTH_RADIUS
+from utilities.cache import DEFAULT_CACHE_DIR, get_config_polygons, get_reprojected_cached
+from utilities.geojson import filter_features_by_proximity, get_polygons, read_features
+from utilities.plotting import (
+    get_projection_xticks, get_projection_yticks,
+    plot_polygon, plot_polygons_collection,
+)
+from utilities.projection import (
+    calc_square_boundary, transverse_mercator_projection,
+)
+from utilities.zonal import get_density_per_area_zonal
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTION_CONFIGS = [
+    ('United States', "New York"),
+    ("United Kingdom", "London"),
+    ("France", "Paris"),
+    ("South Korea", "Seoul"),
+    ("Egypt", "Greater Cairo"),
+    ("India", "Mumbai"),
+    ("Bangladesh", "Dhaka"),
+    ("Phillipines", "Manila"),
+]
+
+DENSITY_CONFIGS = [
+    ('United States', "New York", (0, 0.0)),
+    ("United Kingdom", "London", (0.7, 0.0)),
+    ("France", "Paris", (1.4, 0.0)),
+    ("South Korea", "Seoul", (2.1, 0.0)),
+    ("Egypt", "Greater Cairo", (0.0, -0.75)),
+    ("India", "Mumbai", (0.7, -0.75)),
+    ("Bangladesh", "Dhaka", (1.4, -0.75)),
+    ("Phillipines", "Manila", (2.1, -0.75)),
+]
+
+EARTH_RADIUS_KM = 6_378.137 # kilometres. At equator so use WGS-84 semi major axis
+
+
+# -------------------------------------------#
+#              Panel data
+# -------------------------------------------#
+
+
+def prepare_distribution_panel(
+        country: str, city: str, data_dir: str, length: float = 60_000, cache_dir: str = DEFAULT_CACHE_DIR
+    ):
+    """
+    Population raster for a square of sides `length` metres around the city, projected onto a transverse mercator projection.
+    """
+    config = CONFIG[country]
+    raster_filepath = os.path.join(data_dir, 'rasters', config["raster filepath"])
+    admin_polygons = get_config_polygons(config, city, data_dir, identifier='shapeID', cache_dir=cache_dir)
+    border_polygon = shapely.unary_union(list(admin_polygons.values()))
+    long_min, lat_min, long_max, lat_max = border_polygon.bounds
+    long_avg = (long_min + long_max) / 2
+    border_proj = transverse_mercator_projection({'region': border_polygon}, long_avg)
+    boundary = box(*calc_square_boundary(border_polygon, length, radius=EARTH_RADIUS))
+    img_proj, transform_proj = get_reprojected_cached(raster_filepath, boundary.bounds, long_avg, cache_dir=cache_dir)
+    return {
+        "region_name": f"{city}, {country}",
+        "image": img_proj,
+        "transform": transform_proj,
+        "border": list(border_proj.values()),
+    }
+
+
+def prepare_density_panel(
+        country: str,
+        city: str,
+        data_dir: str,
+        radius: float = 35,
+        min_distance: float = 50e3,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+    ):
+    """
+    Densities of the administrative areas within `min_distance` metres of the city's centre,
+    projected onto a transverse mercator projection and clipped to a circle of `radius` kilometres.
+    """
+    config = CONFIG[country]
+    geojson_filepath = os.path.join(data_dir, 'borders', config["geojson filepath"])
+    raster_filepath = os.path.join(data_dir, 'rasters', config["raster filepath"])
+    admin_polygons = get_config_polygons(config, city, data_dir, identifier='shapeName', cache_dir=cache_dir)
+    border_polygon = shapely.unary_union(list(admin_polygons.values()))
+    central_point = (border_polygon.centroid.x, border_polygon.centroid.y)
+    features = filter_features_by_proximity(
+        {'features': read_features(geojson_filepath)}, central_point, min_distance)
+    region_polygons = get_polygons(features, identifier="shapeName")
+    long_min, lat_min, long_max, lat_max = border_polygon.bounds
+    long_avg = (long_min + long_max) / 2
+    polygons_proj = transverse_mercator_projection(admin_polygons, long_avg)
+    border_polygon_proj = shapely.unary_union(list(polygons_proj.values()))
+    polygons_region_proj = transverse_mercator_projection(region_polygons, long_avg)
+    x_min, y_min, x_max, y_max = border_polygon_proj.bounds
+    x_mid = (x_min + x_max) / 2
+    y_mid = (y_min + y_max) / 2
+    angles = np.linspace(0, 2*np.pi, 1000)
+    circle = Polygon(zip(x_mid + radius * np.cos(angles), y_mid + radius * np.sin(angles)))
+    polygons_region_proj = {key: circle.intersection(poly) for key, poly in polygons_region_proj.items()}
+    polygons_region_proj = {key: poly for key, poly in polygons_region_proj.items() if not poly.is_empty}
+    with rasterio.open(raster_filepath) as src:
+        polygons_raster = [region_polygons[key] for key in polygons_region_proj]
+        densities, _, _ = get_density_per_area_zonal(src, polygons_raster)
+    return {
+        "region_name": f"{city}, {country}",
+        "polygons": list(polygons_region_proj.values()),
+        "densities": densities,
+        "border": border_polygon_proj,
+        "circle": circle,
+        "y_mid": y_mid,
+    }
+
+
+def prepare_panels(prepare_fn, configs: List[tuple], data_dir: str, workers: int = None, **kwargs):
+    """
+    Run `prepare_fn(country, city, data_dir)` for each config in a process pool.
+    Panels which fail are logged and returned as None.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(prepare_fn, country, city, data_dir, **kwargs) for country, city, *_ in configs]
+        panels = []
+        for (country, city, *_), future in zip(configs, futures):
+            try:
+                panels.append(future.result())
+                logger.info(f"Prepared {city}, {country}.")
+            except Exception as e:
+                logger.error(f"Failed for {city}, {country}: {e}")
+                panels.append(None)
+    return panels
+
+
+# -------------------------------------------#
+#                  Figures
+# -------------------------------------------#
+
+
+def compose_distribution_figure(panels: List[dict], cmap: str = 'inferno', vmax: float = 1000, scale: str = "log"):
+    fig, axes = plt.subplots(nrows=2, ncols=4, figsize=(14, 7))
+    cbar_axis = fig.add_axes([0.95, 0.15, 0.03, 0.7])
+    cmap = plt.get_cmap(cmap)
+    if scale == "log":
+        vmax = np.log10(vmax)
+    axis_image = None
+    for idx, panel in enumerate(panels):
+        i, j = idx // 4, idx % 4
+        ax = axes[i][j]
+        if panel is None:
+            ax.set_axis_off()
+            continue
+        ax.set_title(panel["region_name"])
+        img_proj = panel["image"]
+        if scale == "log":
+            axis_image = ax.imshow(np.log10(img_proj + 1), vmax=vmax, cmap=cmap)
+        else:
+            axis_image = ax.imshow(img_proj, vmax=vmax, cmap=cmap)
+        transform_proj = panel["transform"]
+        plot_polygons_collection(ax, panel["border"], transform_proj.__invert__(), color='w', linewidth=1.0)
+        height_proj, width_proj = img_proj.shape
+        x_ticks, x_ticklabels = get_projection_xticks(transform_proj, width_proj, height_proj, step_size=20)
+        y_ticks, y_ticklabels = get_projection_yticks(transform_proj, width_proj, height_proj, step_size=10)
+        y_ticklabels -= y_ticklabels[0]
+        ax.set_xticks(x_ticks, x_ticklabels if i == 1 else [])
+        ax.set_yticks(y_ticks, y_ticklabels if j == 0 else [])
+    if axis_image is not None:
+        cbar = fig.colorbar(axis_image, cax=cbar_axis, extend='max')
+        cbar.set_label('people/(3\"x3\")', rotation=270) # counts
+        if scale == "log":
+            ticks = np.append(np.arange(vmax - 0.1), vmax)
+            tick_labels = [f'{x:.0f}' for x in 10 ** ticks]
+        else:
+            ticks = np.append(np.arange(0, vmax - 1, step=200), vmax)
+            tick_labels = [f'{x:d}' for x in ticks]
+        cbar.ax.set_yticks(ticks)
+        cbar.ax.set_yticklabels(tick_labels)
+    axes[0][0].set_ylabel('km')
+    axes[1][0].set_ylabel('km')
+    return fig
+
+
+def compose_density_figure(
+        panels: List[dict],
+        positions: List[tuple],
+        cmap: str = 'inferno',
+        vmax: float = 50_000,
+        radius: float = 35,
+        background_color: str = 'deepskyblue',
+    ):
+    fig, ax = plt.subplots(figsize=(10, 6))
+    cmap = plt.get_cmap(cmap)
+    p = None
+    for panel, relative_pos in zip(panels, positions):
+        if panel is None:
+            continue
+        offset = np.array((0, -panel["y_mid"])) + np.array(relative_pos) * np.pi / 180 * EARTH_RADIUS_KM
+        circle = panel["circle"]
+        ax.add_patch(matplotlib.patches.Polygon(
+            np.asarray(circle.exterior.coords) + offset, facecolor=background_color, edgecolor='k'))
+        p = plot_polygons_collection(
+            ax, panel["polygons"], values=panel["densities"], offset=offset, edgecolor='w', linewidth=0.4, cmap=cmap)
+        p.set_clim(0, vmax)
+        plot_polygon(ax, panel["border"], 'w-', offset=offset, linewidth=1.0)
+        plot_polygon(ax, circle, 'k-', offset=offset) # border circle
+    ax.autoscale()
+    ax.set_aspect('equal')
+    if p is not None:
+        cbar_axis = fig.add_axes([ax.get_position().x1+0.01, ax.get_position().y0, 0.025, ax.get_position().height])
+        cbar = fig.colorbar(p, cbar_axis, extend='max')
+        cbar.set_label('people/km^2', rotation=270, labelpad=15) # density
+    # labels
+    fig_size = fig.get_size_inches()
+    xlims = ax.get_xlim()
+    pixels_per_inch = (xlims[1] - xlims[0]) / fig_size[0]
+    fontsize = 10
+    for panel, relative_pos in zip(panels, positions):
+        if panel is None:
+            continue
+        region_name = panel["region_name"]
+        x_offset = pixels_per_inch * (len(region_name)/3 * fontsize * 1/72)
+        x, y = np.array(relative_pos) * np.pi / 180 * EARTH_RADIUS_KM + np.array((-x_offset, radius*1.1))
+        ax.text(x, y, region_name, fontsize=fontsize)
+    ax.set_ylim(ymax=48)
+    ax.set_xticklabels([])
+    ax.set_yticklabels([])
+    return fig
+
+
+# -------------------------------------------#
+#                  Main
+# -------------------------------------------#
+
+
+def render_distribution(data_dir: str, output_dir: str, workers: int = None, cmap: str = 'inferno', **kwargs):
+    panels = prepare_panels(prepare_distribution_panel, DISTRIBUTION_CONFIGS, data_dir, workers=workers, **kwargs)
+    fig = compose_distribution_figure(panels, cmap=cmap)
+    outpath = os.path.join(output_dir, f"group_distribution_{cmap}_log.png")
+    fig.savefig(outpath, bbox_inches="tight")
+    plt.close(fig)
+    logger.info(f"Saved figure to {outpath}")
+    return outpath
+
+
+def render_densities(data_dir: str, output_dir: str, workers: int = None, cmap: str = 'inferno', **kwargs):
+    panels = prepare_panels(prepare_density_panel, DENSITY_CONFIGS, data_dir, workers=workers, **kwargs)
+    positions = [relative_pos for _, _, relative_pos in DENSITY_CONFIGS]
+    fig = compose_density_figure(panels, positions, cmap=cmap)
+    outpath = os.path.join(output_dir, f"group_densities_{cmap}.png")
+    fig.savefig(outpath, bbox_inches="tight")
+    plt.close(fig)
+    logger.info(f"Saved figure to {outpath}")
+    return outpath
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=os.path.join('..', '..', 'datasets', 'geospatial'),
+                        help="Directory with the 'borders' and 'rasters' folders.")
+    parser.add_argument('--output-dir', default='images', help="Directory for the figures.")
+    parser.add_argument('--figures', nargs='*', default=['distribution', 'densities'],
+                        choices=['distribution', 'densities'], help="Figures to render.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes. Defaults to the number of CPUs.")
+    parser.add_argument('--cmap', default='inferno', help="Matplotlib colour map.")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory for the geometry cache.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    os.makedirs(args.output_dir, exist_ok=True)
+    if 'distribution' in args.figures:
+        render_distribution(args.data_dir, args.output_dir, workers=args.workers, cmap=args.cmap, cache_dir=args.cache_dir)
+    if 'densities' in args.figures:
+        render_densities(args.data_dir, args.output_dir, workers=args.workers, cmap=args.cmap, cache_dir=args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely import MultiPolygon, Polygon, box
+
+from utilities.area import show_stats, show_stats_chunked
+
+PIXEL_SIZE = 3 / 3600
+
+
+def make_raster(filepath, size: int = 200, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    data = rng.gamma(0.8, 20, size=(size, size)).astype(np.float32)
+    data[rng.random(data.shape) < 0.3] = -99999
+    profile = {
+        'driver': 'GTiff', 'height': size, 'width': size, 'count': 1, 'dtype': 'float32',
+        'crs': 'EPSG:4326', 'transform': from_origin(30.0, -26.0, PIXEL_SIZE, PIXEL_SIZE), 'nodata': -99999,
+    }
+    with rasterio.open(filepath, 'w', **profile) as dst:
+        dst.write(data, 1)
+    return filepath
+
+
+def test_show_stats_chunked_matches_show_stats(tmp_path, capsys):
+    filepath = make_raster(str(tmp_path / "population.tif"))
+    outer = box(30.01, -26.15, 30.04, -26.01)
+    hole = box(30.02, -26.1, 30.03, -26.05)
+    geometries = [
+        Polygon(outer.exterior.coords, holes=[hole.exterior.coords]),
+        MultiPolygon([box(30.045, -26.15, 30.05, -26.1)]),
+    ]
+    with rasterio.open(filepath) as src:
+        show_stats(src, geometries)
+        expected = capsys.readouterr().out
+        show_stats_chunked(src, geometries, max_bytes=2**14)
+        assert capsys.readouterr().out == expected
@@ -0,0 +1,38 @@
+import json
+import pytest
+
+from utilities.geojson import iter_features, read_features
+
+
+def make_feature(shape_id: str, x: float):
+    return {
+        "type": "Feature",
+        "properties": {"shapeID": shape_id, "shapeName": f"Area {shape_id}"},
+        "geometry": {"type": "Polygon", "coordinates": [[[x, 0], [x + 1, 0], [x + 1, 1], [x, 0]]]},
+    }
+
+
+def write_collection(filepath, features, **members):
+    # members are written before "features" to test that nested keys are not mistaken for it
+    collection = dict(type="FeatureCollection", **members, features=features)
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(collection, f)
+    return str(filepath)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64, 2**20])
+def test_iter_features_skips_nested_features_key(tmp_path, chunk_size):
+    features = [make_feature(str(idx), idx) for idx in range(5)]
+    filepath = write_collection(
+        tmp_path / "borders.geojson",
+        features,
+        metadata={"features": [], "note": "a \"features\": [ string", "nested": {"features": [make_feature("x", 9)]}},
+        crs={"type": "name", "properties": {"name": "EPSG:4326", "features": [1, 2]}},
+    )
+    assert list(iter_features(filepath, chunk_size=chunk_size)) == features
+
+
+def test_read_features_filters_by_property(tmp_path):
+    features = [make_feature(str(idx), idx) for idx in range(5)]
+    filepath = write_collection(tmp_path / "borders.geojson", features, metadata={"features": [make_feature("1", 9)]})
+    assert read_features(filepath, "shapeID", ["1", "3"], chunk_size=16) == [features[1], features[3]]
@@ -0,0 +1,32 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.collections
+import matplotlib.pyplot as plt
+import numpy as np
+from shapely import MultiPolygon, box
+
+from utilities.plotting import get_exterior_rings, plot_polygons_collection
+
+
+def test_plot_polygons_collection_dict_values():
+    polygons = {
+        "a": box(0, 0, 1, 1),
+        "b": MultiPolygon([box(2, 0, 3, 1), box(4, 0, 5, 1)]),
+    }
+    fig, ax = plt.subplots()
+    collection = plot_polygons_collection(ax, polygons.values())
+    assert isinstance(collection, matplotlib.collections.LineCollection)
+    assert len(collection.get_segments()) == 3
+
+    collection = plot_polygons_collection(ax, polygons.values(), values=[1.0, 2.0])
+    assert isinstance(collection, matplotlib.collections.PolyCollection)
+    np.testing.assert_array_equal(collection.get_array(), [1.0, 2.0, 2.0])
+    plt.close(fig)
+
+
+def test_get_exterior_rings_transform():
+    rings, index = get_exterior_rings({"a": box(0, 0, 1, 1)}.values(), transform=(2, 0, 10, 0, -1, 5))
+    assert len(rings) == 1
+    np.testing.assert_array_equal(index, [0])
+    assert rings[0][:, 0].min() == 10 and rings[0][:, 0].max() == 12
+    assert rings[0][:, 1].min() == 4 and rings[0][:, 1].max() == 5
@@ -1,9 +1,17 @@
 import logging
 import numpy as np
 import rasterio
+import rasterio.errors
+import rasterio.features
 import rasterio.mask
+import rasterio.windows
+import shapely
+from rasterio.windows import Window
 from shapely import MultiPolygon, Polygon
-from typing import List, Union
+from typing import Iterator, List, Union
+
+from utilities import profiling
+from utilities.raster import BlockReader, RasterStore
 
 logger = logging.getLogger(__name__)
 
@@ -73,26 +81,129 @@ def calc_area(
     area = radius * radius * poly_cylindrical.area # metres^2
     return area
 
+
+def calc_areas_ragged(
+        coords: np.ndarray,
+        ring_offsets: np.ndarray,
+        polygon_offsets: np.ndarray,
+        geometry_offsets: np.ndarray = None,
+        radius: float = EARTH_RADIUS,
+        holes: bool = True,
+    ):
+    """
+    Calculate the areas of many polygons on the surface of a sphere in one pass.
+    Uses the same cylindrical projection as `calc_area`.
+
+    The polygons are flat arrays in the layout of `shapely.to_ragged_array`:
+    - `coords` are (longitude, latitude) pairs in degrees for all rings.
+    - Ring `i` is `coords[ring_offsets[i]:ring_offsets[i + 1]]`.
+    - Polygon `j` has rings `polygon_offsets[j]:polygon_offsets[j + 1]`. The first ring is the exterior and the rest are holes.
+    - Geometry `k` has polygons `geometry_offsets[k]:geometry_offsets[k + 1]`. If None, each polygon is a geometry.
+    If `holes` is False the holes are not subtracted, as in `get_density_per_area`.
+    By default, the radius is 6,371,007 metres and the result is returned in metres^2.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.size == 0:
+        coords = coords.reshape(0, 2)
+    ring_offsets = np.asarray(ring_offsets)
+    polygon_offsets = np.asarray(polygon_offsets)
+    num_rings = len(ring_offsets) - 1
+    num_polygons = len(polygon_offsets) - 1
+    ring_lengths = np.diff(ring_offsets)
+    ring_ids = np.repeat(np.arange(num_rings), ring_lengths)
+    # project and shift each ring to its first vertex for precision
+    xs = np.deg2rad(coords[:, 0])
+    ys = np.sin(np.deg2rad(coords[:, 1]))
+    ring_starts = ring_offsets[:-1][ring_lengths > 0]
+    ring_ends = ring_offsets[1:][ring_lengths > 0] - 1
+    first = np.zeros(num_rings, dtype=np.int64)
+    first[ring_lengths > 0] = ring_starts
+    xs = xs - xs[first[ring_ids]]
+    ys = ys - ys[first[ring_ids]]
+    # shoelace formula: consecutive vertices of the same ring plus the closing edge
+    cross = xs[:-1] * ys[1:] - xs[1:] * ys[:-1]
+    same_ring = ring_ids[:-1] == ring_ids[1:]
+    signed_areas = np.bincount(
+        ring_ids[:-1][same_ring], weights=cross[same_ring], minlength=num_rings
+    ).astype(np.float64)
+    closing = xs[ring_ends] * ys[ring_starts] - xs[ring_starts] * ys[ring_ends]
+    signed_areas[ring_lengths > 0] += closing
+    ring_areas = 0.5 * np.abs(signed_areas)
+    # exteriors minus holes
+    polygon_ids = np.repeat(np.arange(num_polygons), np.diff(polygon_offsets))
+    is_exterior = np.arange(num_rings) == polygon_offsets[:-1][polygon_ids]
+    sign = np.where(is_exterior, 1.0, -1.0 if holes else 0.0)
+    areas = np.bincount(polygon_ids, weights=sign * ring_areas, minlength=num_polygons)
+    if geometry_offsets is not None:
+        geometry_offsets = np.asarray(geometry_offsets)
+        num_geometries = len(geometry_offsets) - 1
+        geometry_ids = np.repeat(np.arange(num_geometries), np.diff(geometry_offsets))
+        areas = np.bincount(geometry_ids, weights=areas, minlength=num_geometries)
+    return radius * radius * areas # metres^2
+
+
+def calc_geometry_areas(
+        geometries: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS,
+        holes: bool = True,
+    ):
+    """
+    Calculate the area on a sphere of every Polygon or MultiPolygon with `calc_areas_ragged`.
+    The coordinates must be longitudes and latitudes in degrees.
+    """
+    geometries = np.asarray(list(geometries), dtype=object)
+    if len(geometries) == 0:
+        return np.zeros(0)
+    with profiling.stage("area.calc_geometry_areas", logger):
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+        if geometry_type == shapely.GeometryType.POLYGON:
+            ring_offsets, polygon_offsets = offsets
+            geometry_offsets = None
+        elif geometry_type == shapely.GeometryType.MULTIPOLYGON:
+            ring_offsets, polygon_offsets, geometry_offsets = offsets
+        else:
+            raise Exception(f"Geometry type {geometry_type.name} is not supported")
+        areas = calc_areas_ragged(
+            coords, ring_offsets, polygon_offsets, geometry_offsets, radius=radius, holes=holes
+        )
+    profiling.count("area.polygons", len(polygon_offsets) - 1)
+    profiling.count("area.vertices", len(coords))
+    return areas
+
 # -------------------------------------------#
 #            Density calculations
 # -------------------------------------------#
 
 
+def mask_raster(
+        population_data: Union[rasterio.io.DatasetReader, BlockReader],
+        geometries: List[Union[Polygon, MultiPolygon]],
+    ):
+    """
+    Same as `rasterio.mask.mask(population_data, geometries, crop=True)`.
+    A `BlockReader` reads through its tile cache and a `RasterStore` from its memory map instead.
+    """
+    with profiling.stage("area.mask_raster", logger):
+        if isinstance(population_data, (BlockReader, RasterStore)):
+            clipped_img, transform = population_data.mask(geometries)
+        else:
+            clipped_img, transform = rasterio.mask.mask(population_data, geometries, crop=True)
+            profiling.count("raster.bytes_decoded", clipped_img.nbytes)
+    profiling.count("raster.pixels_read", clipped_img.size)
+    return clipped_img, transform
+
+
 def show_stats(
         population_data: rasterio.io.DatasetReader,
         geometries: List[Union[Polygon, MultiPolygon]],
         radius: float = EARTH_RADIUS
     ):
-    clipped_img, transform = rasterio.mask.mask(population_data, geometries, crop=True)
-    clipped_img[clipped_img < 0] = 0                                            
-    population_count = clipped_img.sum()
-    population_max = clipped_img.max()
-    area = 0
-    for geometry in geometries:
-        polygons = geometry.geoms if isinstance(geometry, MultiPolygon) else [geometry]
-        for polygon in polygons:
-            longs, lats = polygon.exterior.coords.xy
-            area += calc_area(longs, lats, radius=radius) # metres^2
+    with profiling.stage("area.show_stats", logger):
+        clipped_img, transform = mask_raster(population_data, geometries)
+        clipped_img[clipped_img < 0] = 0                                            
+        population_count = clipped_img.sum()
+        population_max = clipped_img.max()
+        area = calc_geometry_areas(geometries, radius=radius, holes=False).sum() # metres^2
     print(f'population: {population_count/1e6:.2f} million')
     print(f'max:        {population_max:.0f} people / pixel')
     print(f'area:       {area/1e6:.2f} km^2')
@@ -106,7 +217,7 @@ def density_per_polygon(
         radius: float = EARTH_RADIUS
     ):
     try:
-        clipped_img, transform = rasterio.mask.mask(population_data, [polygon], crop=True)
+        clipped_img, transform = mask_raster(population_data, [polygon])
         clipped_img[clipped_img < 0] = 0 
         population_count = clipped_img.sum() 
     except ValueError as e:
@@ -114,6 +225,8 @@ def density_per_polygon(
         population_count = 0
     longs, lats = polygon.exterior.coords.xy
     area = calc_area(longs, lats, radius=radius) # metres^2 
+    profiling.count("area.polygons")
+    profiling.count("area.vertices", len(longs))
     density = population_count / (area/1e6)
     return density, population_count, area
 
@@ -127,22 +240,23 @@ def get_density_per_area(
     densities = np.zeros(n)
     population_counts = np.zeros(n)
     areas = np.zeros(n)
-    for idx, shape in enumerate(shapes):
-        if isinstance(shape, Polygon):
-            polygons = [shape]
-        elif isinstance(shape, MultiPolygon):
-            polygons = shape.geoms
-        else:
-            type_ = type(shape)
-            raise Exception(f"type {type_} is not supported")
-        areas[idx] = 0.0
-        population_counts[idx] = 0.0
-        for polygon in polygons:
-            density, population_count, area = density_per_polygon(
-                population_data, polygon, radius=radius)
-            population_counts[idx] += population_count
-            areas[idx] += area
-        densities[idx] = population_counts[idx] / (areas[idx]/1e6) # convert to km2
+    with profiling.stage("area.get_density_per_area", logger):
+        for idx, shape in enumerate(shapes):
+            if isinstance(shape, Polygon):
+                polygons = [shape]
+            elif isinstance(shape, MultiPolygon):
+                polygons = shape.geoms
+            else:
+                type_ = type(shape)
+                raise Exception(f"type {type_} is not supported")
+            areas[idx] = 0.0
+            population_counts[idx] = 0.0
+            for polygon in polygons:
+                density, population_count, area = density_per_polygon(
+                    population_data, polygon, radius=radius)
+                population_counts[idx] += population_count
+                areas[idx] += area
+            densities[idx] = population_counts[idx] / (areas[idx]/1e6) # convert to km2
     return densities, population_counts, areas
 
 
@@ -154,3 +268,180 @@ def get_scales(shape, bounding_polygon: Polygon, radius: float = EARTH_RADIUS):
     lat_scale_bottom = (long_max - long_min) * radius * np.cos(lat_min) / width # metres/pixels
     lat_scale = (lat_scale_top + lat_scale_bottom) / 2
     return long_scale, lat_scale
+
+
+# -------------------------------------------#
+#            Raster pixel areas
+# -------------------------------------------#
+
+
+def calc_pixel_areas(transform, row_start: int, num_rows: int, radius: float = EARTH_RADIUS):
+    """
+    Area in metres^2 of a pixel in each of the rows `row_start` to `row_start + num_rows` of a north up raster in degrees.
+    This is the exact area on a sphere of R^2 * dlong * (sin(lat_top) - sin(lat_bottom)).
+    """
+    if transform.b != 0 or transform.d != 0:
+        raise Exception("Only north up rasters are supported")
+    lats_top = transform.f + transform.e * np.arange(row_start, row_start + num_rows)
+    lats_bottom = lats_top + transform.e
+    dlong = np.deg2rad(abs(transform.a))
+    return radius ** 2 * dlong * np.abs(np.sin(np.deg2rad(lats_top)) - np.sin(np.deg2rad(lats_bottom)))
+
+
+# -------------------------------------------#
+#             Radial profiles
+# -------------------------------------------#
+
+
+def get_radial_profile(
+        population_data: rasterio.io.DatasetReader,
+        centre: tuple,
+        max_distance: float,
+        ring_width: float = 1000,
+        radius: float = EARTH_RADIUS
+    ):
+    """
+    Population and area within `ring_width`, 2 `ring_width`, ... up to `max_distance` metres of the centre (longitude, latitude).
+    Each pixel is placed in a ring by the great circle distance of its centre from `haversine_formula`
+    and the rings are summed with bincount, so any number of radii costs one read of the raster.
+    Pixel areas include nodata pixels. Rings which extend past the edge of the raster are incomplete.
+    Returns the radii in metres, cumulative densities in people/km^2, population counts and areas in metres^2.
+    """
+    long_centre, lat_centre = centre
+    num_rings = int(np.ceil(max_distance / ring_width))
+    radii = ring_width * np.arange(1, num_rings + 1)
+    lat_extent = np.rad2deg(max_distance / radius)
+    lat_furthest = min(abs(lat_centre) + lat_extent, 89.9)
+    long_extent = min(180, lat_extent / np.cos(np.deg2rad(lat_furthest)))
+    window = rasterio.windows.from_bounds(
+        long_centre - long_extent, lat_centre - lat_extent, long_centre + long_extent, lat_centre + lat_extent,
+        transform=population_data.transform)
+    row_start = max(0, int(np.floor(window.row_off)))
+    col_start = max(0, int(np.floor(window.col_off)))
+    row_stop = min(population_data.height, int(np.ceil(window.row_off + window.height)))
+    col_stop = min(population_data.width, int(np.ceil(window.col_off + window.width)))
+    if row_start >= row_stop or col_start >= col_stop:
+        logger.warning(f"Centre {centre} is too far from the raster. Setting population counts to 0.")
+        return radii, np.zeros(num_rings), np.zeros(num_rings), np.zeros(num_rings)
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    transform = population_data.window_transform(window)
+    with profiling.stage("area.radial_profile", logger):
+        img = population_data.read(1, window=window)
+        img[img < 0] = 0
+        height, width = img.shape
+        longs = transform.c + transform.a * (np.arange(width) + 0.5)
+        lats = transform.f + transform.e * (np.arange(height) + 0.5)
+        theta = haversine_formula(
+            np.deg2rad(longs)[np.newaxis, :], np.deg2rad(lats)[:, np.newaxis],
+            np.deg2rad(long_centre), np.deg2rad(lat_centre))
+        rings = (theta * radius // ring_width).astype(np.int64)
+        inside = rings < num_rings
+        rings = rings[inside]
+        pixel_areas = np.broadcast_to(calc_pixel_areas(transform, 0, height, radius=radius)[:, np.newaxis], img.shape)
+        population_counts = np.cumsum(np.bincount(rings, weights=img[inside], minlength=num_rings))
+        areas = np.cumsum(np.bincount(rings, weights=pixel_areas[inside], minlength=num_rings))
+    profiling.count("raster.pixels_read", img.size)
+    densities = population_counts / (areas/1e6) # convert to km2
+    return radii, densities, population_counts, areas
+
+
+# -------------------------------------------#
+#           Chunked statistics
+# -------------------------------------------#
+
+
+def iter_masked_strips(
+        population_data: rasterio.io.DatasetReader,
+        geometries: List[Union[Polygon, MultiPolygon]],
+        max_bytes: int = 256 * 2**20,
+        window: Window = None,
+    ) -> Iterator[tuple]:
+    """
+    Walk the window covering the geometries in strips of whole rows, so only one strip is in memory at a time.
+    Yields the strip of the first band, a mask which is True where the pixel centre is inside the geometries
+    and the strip's window. Strip heights are a multiple of the raster's block height where possible.
+    `max_bytes` bounds the memory of a strip and the temporary arrays made while processing it.
+    A `window` may be given to only walk part of the raster, e.g. one band of rows per worker.
+    Raises ValueError if the geometries do not overlap the raster, as with `rasterio.mask.mask`.
+    """
+    if window is None:
+        try:
+            window = rasterio.features.geometry_window(population_data, geometries)
+        except rasterio.errors.WindowError:
+            raise ValueError('Input shapes do not overlap raster.')
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    itemsize = np.dtype(population_data.dtypes[0]).itemsize
+    # the strip, a copy of its masked values, their float64 copy and the masks made while rasterizing
+    strip_rows = max(1, max_bytes // (width * (2 * itemsize + 8 + 8)))
+    block_height = population_data.block_shapes[0][0]
+    if strip_rows >= block_height:
+        strip_rows -= strip_rows % block_height
+    geometries = np.asarray(list(geometries), dtype=object)
+    for row_start in range(row_off, row_off + height, strip_rows):
+        strip_window = Window(col_off, row_start, width, min(strip_rows, row_off + height - row_start))
+        strip = population_data.read(1, window=strip_window)
+        transform = population_data.window_transform(strip_window)
+        # only rasterize the parts of the geometries within a pixel of the strip
+        left, bottom, right, top = rasterio.windows.bounds(strip_window, population_data.transform)
+        pad_x, pad_y = abs(transform.a), abs(transform.e)
+        clipped = shapely.clip_by_rect(geometries, left - pad_x, bottom - pad_y, right + pad_x, top + pad_y)
+        clipped = clipped[~shapely.is_empty(clipped)]
+        if len(clipped):
+            mask = rasterio.features.geometry_mask(clipped, out_shape=strip.shape, transform=transform, invert=True)
+        else:
+            mask = np.zeros(strip.shape, dtype=bool)
+        profiling.count("raster.pixels_read", strip.size)
+        yield strip, mask, strip_window
+
+
+def calc_stats_chunked(
+        population_data: rasterio.io.DatasetReader,
+        geometries: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS,
+        max_bytes: int = 256 * 2**20,
+    ) -> dict:
+    """
+    Population sum, maximum pixel value, pixel count and pixel area in metres^2 of the geometries,
+    accumulated in float64 over strips from `iter_masked_strips`. Negative (nodata) pixels are counted as 0.
+    """
+    population_count = 0.0
+    population_max = 0.0
+    pixel_count = 0
+    pixel_area = 0.0
+    with profiling.stage("area.calc_stats_chunked", logger):
+        for strip, mask, strip_window in iter_masked_strips(population_data, geometries, max_bytes=max_bytes):
+            values = strip[mask].astype(np.float64)
+            values[values < 0] = 0
+            if values.size:
+                population_count += values.sum()
+                population_max = max(population_max, values.max())
+            row_counts = mask.sum(axis=1)
+            pixel_count += int(row_counts.sum())
+            row_areas = calc_pixel_areas(population_data.transform, strip_window.row_off, strip.shape[0], radius=radius)
+            pixel_area += float(row_counts @ row_areas)
+    return {
+        "population": population_count,
+        "max": population_max,
+        "pixels": pixel_count,
+        "pixel_area": pixel_area,
+    }
+
+
+def show_stats_chunked(
+        population_data: rasterio.io.DatasetReader,
+        geometries: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS,
+        max_bytes: int = 256 * 2**20,
+    ):
+    """
+    Same output as `show_stats` with memory bounded by `max_bytes`, for geometries as large as whole countries.
+    """
+    stats = calc_stats_chunked(population_data, geometries, radius=radius, max_bytes=max_bytes)
+    area = calc_geometry_areas(geometries, radius=radius, holes=False).sum() # metres^2
+    print(f'population: {stats["population"]/1e6:.2f} million')
+    print(f'max:        {stats["max"]:.0f} people / pixel')
+    print(f'area:       {area/1e6:.2f} km^2')
+    density = stats["population"] / (area/1e6)
+    print(f'density:    {density:.2f} people/km^2')
+    return stats
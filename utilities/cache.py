@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import rasterio
+import rasterio.mask
+import shapely
+from rasterio import Affine
+from rasterio.warp import Resampling
+from shapely import MultiPolygon, Polygon, box
+from typing import Dict, List, Tuple, Union
+
+from utilities import profiling
+from utilities.geojson import get_polygons, read_features
+from utilities.projection import get_transverse_mercator_crs, reproject_image
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '.cache'
+
+
+def hash_key(key) -> str:
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def write_atomic(filepath: str, save_fn):
+    """
+    Write to a temporary file with `save_fn(file)` and then move it into place,
+    so that readers never see a partially written file.
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp_filepath, filepath)
+
+
+# -------------------------------------------#
+#              Geometry cache
+# -------------------------------------------#
+
+
+def save_geometries(filepath: str, shapes: Dict[str, Union[Polygon, MultiPolygon]]):
+    """
+    Save geometries as concatenated WKB with offsets in a .npz file.
+    """
+    wkbs = shapely.to_wkb(np.asarray(list(shapes.values()), dtype=object))
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(wkb) for wkb in wkbs])
+    buffer = np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+    names = np.array(list(shapes.keys()), dtype=str)
+    write_atomic(filepath, lambda f: np.savez(f, names=names, wkb=buffer, offsets=offsets))
+
+
+def load_geometries(filepath: str) -> Dict[str, Union[Polygon, MultiPolygon]]:
+    with np.load(filepath) as data:
+        names = data['names'].tolist()
+        buffer = data['wkb'].tobytes()
+        offsets = data['offsets']
+    wkbs = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    geometries = shapely.from_wkb(wkbs)
+    return dict(zip(names, geometries))
+
+
+def get_polygons_cached(
+        geojson_filepath: str,
+        feature_ids: List[str] = None,
+        prop_name: str = 'shapeID',
+        identifier: str = 'shapeName',
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        **kwargs
+    ):
+    """
+    Same as `get_polygons` on the features of `geojson_filepath` where `prop_name` is in `feature_ids`.
+    If `feature_ids` is empty or None, all features are used.
+    The polygons are cached on disk, keyed by the source path, its modification time and size,
+    the feature ids and the other arguments. A change to any of these invalidates the cache.
+    """
+    selection_key = hash_key({
+        "path": os.path.abspath(geojson_filepath),
+        "feature_ids": list(feature_ids) if feature_ids else None,
+        "prop_name": prop_name,
+        "identifier": identifier,
+        "kwargs": kwargs,
+    })
+    stat = os.stat(geojson_filepath)
+    source_key = hash_key({"mtime": stat.st_mtime_ns, "size": stat.st_size})
+    directory = os.path.join(cache_dir, 'geometries')
+    filepath = os.path.join(directory, f"{selection_key}-{source_key}.npz")
+    if os.path.isfile(filepath):
+        logger.info(f"Loading cached geometries from {filepath}")
+        return load_geometries(filepath)
+    if feature_ids:
+        features = read_features(geojson_filepath, prop_name, feature_ids)
+        if len(features) != len(feature_ids):
+            logger.warning(f"Found {len(features)} features for {len(feature_ids)} ids in {geojson_filepath}.")
+    else:
+        features = read_features(geojson_filepath)
+    shapes = get_polygons(features, identifier=identifier, **kwargs)
+    # remove entries for older versions of the source file
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.startswith(f"{selection_key}-") and filename.endswith('.npz'):
+                os.remove(os.path.join(directory, filename))
+    save_geometries(filepath, shapes)
+    logger.info(f"Saved {len(shapes)} geometries to {filepath}")
+    return shapes
+
+
+def get_cities(config: dict, countries: list = None):
+    """
+    (country, city) pairs of `data.config.CONFIG`, optionally only for `countries`.
+    Cities without configured features are skipped.
+    """
+    cities = []
+    for country, country_config in config.items():
+        if countries and country not in countries:
+            continue
+        for city, features in country_config["features"].items():
+            if not features:
+                logger.warning(f"Skipping {city}, {country}: no features configured.")
+                continue
+            cities.append((country, city))
+    return cities
+
+
+def get_config_polygons(config: dict, city: str, data_dir: str, identifier: str = 'shapeName', **kwargs):
+    """
+    Load the polygons of a city from an entry of `data.config.CONFIG` through the geometry cache.
+    The borders are expected at `data_dir/borders/<geojson filepath>`.
+    """
+    geojson_filepath = os.path.join(data_dir, 'borders', config["geojson filepath"])
+    feature_ids = [prop[0] for prop in config["features"][city]]
+    return get_polygons_cached(geojson_filepath, feature_ids, prop_name='shapeID', identifier=identifier, **kwargs)
+
+
+# -------------------------------------------#
+#            Reprojection cache
+# -------------------------------------------#
+
+
+_checksums = {}
+
+
+def file_checksum(filepath: str, cache_dir: str = DEFAULT_CACHE_DIR, chunk_size: int = 2**24) -> str:
+    """
+    SHA-256 checksum of a file's contents.
+    Checksums are memoized in memory and on disk by path, modification time and size, so large rasters are hashed once.
+    """
+    stat = os.stat(filepath)
+    key = hash_key({"path": os.path.abspath(filepath), "mtime": stat.st_mtime_ns, "size": stat.st_size})
+    if key in _checksums:
+        return _checksums[key]
+    memo_filepath = os.path.join(cache_dir, 'checksums', f"{key}.txt")
+    if os.path.isfile(memo_filepath):
+        with open(memo_filepath, 'r') as f:
+            checksum = f.read().strip()
+    else:
+        sha = hashlib.sha256()
+        with profiling.stage("cache.file_checksum", logger):
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha.update(chunk)
+        checksum = sha.hexdigest()
+        write_atomic(memo_filepath, lambda f: f.write(checksum.encode('utf-8')))
+    _checksums[key] = checksum
+    return checksum
+
+
+def evict_lru(directory: str, max_bytes: int, suffix: str = '.npy'):
+    """
+    Remove the least recently used entries of a cache directory until the entries with `suffix` fit in `max_bytes`.
+    An entry is all files sharing the key before the suffix. Entries are touched on use, so modification time is the recency.
+    """
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for filename in os.listdir(directory):
+        if filename.endswith(suffix):
+            stat = os.stat(os.path.join(directory, filename))
+            entries.append((stat.st_mtime_ns, stat.st_size, filename[:-len(suffix)]))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        for filename in os.listdir(directory):
+            if filename.startswith(key):
+                os.remove(os.path.join(directory, filename))
+        total -= size
+        profiling.count("cache.evictions")
+        logger.debug(f"Evicted {key} from {directory}")
+
+
+def get_reprojected_cached(
+        raster_filepath: str,
+        bounds: Tuple[float, float, float, float],
+        lon_0: float,
+        resolution: float = None,
+        resampling: Resampling = Resampling.bilinear,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = 2**30,
+    ):
+    """
+    Crop of a population raster to `bounds` in degrees, with negative values set to 0,
+    projected onto the transverse mercator projection centred on `lon_0` with `projection.reproject_image`.
+    Results are cached on disk as a .npy array and a JSON file with the transform, keyed by the raster's checksum
+    and the arguments. Hits are returned as read only memory maps. The least recently used entries are removed
+    once the arrays take more than `max_bytes`.
+    Returns the projected image and its transform.
+    """
+    key = hash_key({
+        "checksum": file_checksum(raster_filepath, cache_dir=cache_dir),
+        "bounds": [float(x) for x in bounds],
+        "lon_0": float(lon_0),
+        "resolution": resolution,
+        "resampling": Resampling(resampling).name,
+    })
+    directory = os.path.join(cache_dir, 'reprojected')
+    array_filepath = os.path.join(directory, f"{key}.npy")
+    meta_filepath = os.path.join(directory, f"{key}.json")
+    if os.path.isfile(meta_filepath) and os.path.isfile(array_filepath):
+        os.utime(array_filepath)
+        with open(meta_filepath, 'r') as f:
+            meta = json.load(f)
+        profiling.count("cache.reprojected_hits")
+        return np.load(array_filepath, mmap_mode='r'), Affine(*meta["transform"])
+    profiling.count("cache.reprojected_misses")
+    with profiling.stage("cache.reproject", logger):
+        with rasterio.open(raster_filepath) as src:
+            img, transform = rasterio.mask.mask(src, [box(*bounds)], crop=True)
+            img[img < 0] = 0
+            crs_src = src.crs
+        img_proj, transform_proj = reproject_image(
+            img[0, :, :], transform, crs_src, get_transverse_mercator_crs(lon_0), bounds,
+            resolution=resolution, resampling=resampling)
+    write_atomic(array_filepath, lambda f: np.save(f, img_proj))
+    meta = {"transform": list(transform_proj)[:6], "shape": list(img_proj.shape), "source": raster_filepath}
+    write_atomic(meta_filepath, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    evict_lru(directory, max_bytes)
+    return img_proj, transform_proj
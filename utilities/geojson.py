@@ -1,7 +1,13 @@
+import json
 import logging
+import numpy as np
+import re
+import shapely
+from itertools import chain
 from shapely import Polygon, MultiPolygon, Point
-from typing import List, Union
-from utilities.area import calc_great_circle_distance, EARTH_AUTHALIC_RADIUS
+from typing import Dict, Iterable, Iterator, List, Sequence, Union
+from utilities import profiling
+from utilities.area import haversine_formula, EARTH_AUTHALIC_RADIUS
 
 logger = logging.getLogger(__name__)
 
@@ -25,9 +31,10 @@ def filter_features_by_list(shape_data: List[dict], prop_name: str, prop_list: L
     """
     Return features that match at least one value in a list of values for a given property.
     """
+    prop_set = set(prop_list)
     features = []
     for feature in shape_data['features']:
-        if feature['properties'][prop_name] in prop_list:
+        if feature['properties'][prop_name] in prop_set:
             features.append(feature)
     return features
 
@@ -49,13 +56,43 @@ def filter_features_by_bounds(shape_data: List[dict], boundary: Polygon):
     Return features that fit entirely within the boundary.
     """
     valid_features =  []
-    for idx, feature in enumerate(shape_data['features']):
-        coordinates = extract_coordinates(feature['geometry'])
-        if all(boundary.contains(Point(*point)) for point in coordinates):
-            valid_features.append(feature)
+    with profiling.stage("geojson.filter_features_by_bounds", logger):
+        for idx, feature in enumerate(shape_data['features']):
+            coordinates = extract_coordinates(feature['geometry'])
+            if all(boundary.contains(Point(*point)) for point in coordinates):
+                valid_features.append(feature)
     return valid_features
 
 
+def gather_coordinates(features: List[dict]):
+    """
+    Gather the exterior coordinates of all features into one contiguous (n, 2) array.
+    The coordinates of feature `i` are `coords[offsets[i]:offsets[i + 1]]`.
+    """
+    coords_list = [np.asarray(extract_coordinates(feature['geometry']), dtype=float) for feature in features]
+    offsets = np.zeros(len(coords_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(coords) for coords in coords_list])
+    if offsets[-1] == 0:
+        return np.zeros((0, 2)), offsets
+    coords = np.concatenate([coords[:, :2] for coords in coords_list if len(coords)])
+    return coords, offsets
+
+
+def calc_proximity_bounds(point: tuple, great_circle_distance: float, earth_radius: float = EARTH_AUTHALIC_RADIUS):
+    """
+    Half widths in degrees of a longitude/latitude box around the point which contains every point
+    within the `great_circle_distance`.
+    """
+    theta = great_circle_distance / earth_radius
+    lat = np.deg2rad(point[1])
+    if abs(lat) + theta >= np.pi / 2:
+        # a pole is within range so all longitudes are possible
+        long_half_width = np.pi
+    else:
+        long_half_width = np.arcsin(np.sin(theta) / np.cos(lat))
+    return np.rad2deg(long_half_width), np.rad2deg(min(theta, np.pi))
+
+
 def filter_features_by_proximity(
         shape_data: List[dict],
         point: tuple,
@@ -65,15 +102,26 @@ def filter_features_by_proximity(
     """
     Return features where at least one point falls with in the `great_circle_distance`.
     By default, the radius is 6,371,007 metres.
+    Vertices outside a bounding box around the point are rejected before calculating distances.
     """
-    valid_features =  []
-    for idx, feature in enumerate(shape_data['features']):
-        coordinates = extract_coordinates(feature['geometry'])
-        for coord in coordinates:
-            d = calc_great_circle_distance(coord, point, radius=earth_radius)
-            if d <= great_circle_distance:
-                valid_features.append(feature)
-                break
+    features = shape_data['features']
+    with profiling.stage("geojson.gather_coordinates", logger):
+        coords, offsets = gather_coordinates(features)
+    profiling.count("geojson.vertices", len(coords))
+    feature_ids = np.repeat(np.arange(len(features)), np.diff(offsets))
+    # prefilter
+    long_half_width, lat_half_width = calc_proximity_bounds(point, great_circle_distance, earth_radius)
+    eps = 1e-9 # degrees
+    delta_long = (coords[:, 0] - point[0] + 180) % 360 - 180
+    delta_lat = coords[:, 1] - point[1]
+    candidates = (np.abs(delta_long) <= long_half_width + eps) & (np.abs(delta_lat) <= lat_half_width + eps)
+    # distances
+    long1, lat1 = np.deg2rad(coords[candidates].T)
+    long2, lat2 = np.deg2rad(point[0]), np.deg2rad(point[1])
+    distances = earth_radius * haversine_formula(long1, lat1, long2, lat2)
+    within = feature_ids[candidates][distances <= great_circle_distance]
+    is_valid = np.bincount(within, minlength=len(features)) > 0
+    valid_features = [features[idx] for idx in np.flatnonzero(is_valid)]
     return valid_features
 
 
@@ -84,6 +132,148 @@ def filter_features_by_area(shape_data: List[dict], min_area: float):
     pass
 
 
+#--------------------------------#
+#        Streaming
+#--------------------------------#
+
+_FEATURES_KEY = '"features"'
+# strings, unterminated strings and structural characters
+_TOP_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\],]')
+_SEPARATOR = re.compile(r'[\s,]*')
+# strings, unterminated strings and braces. Numbers and brackets in coordinates are skipped over.
+_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}]')
+
+
+def _find_features_start(buffer: str, pos: int, state: tuple):
+    """
+    Find the end of `"features": [` in the top level object, ignoring `features` keys of nested members.
+    `state` is the (depth, expecting a key, last key) of the scan so far and `pos` where it stopped.
+    Returns the position after the opening bracket, or None with the position and state to resume from
+    once more of the file has been read.
+    """
+    depth, expect_key, key = state
+    for match in _TOP_TOKENS.finditer(buffer, pos):
+        token = match.group()
+        if token == '"':
+            return None, match.start(), (depth, expect_key, key)
+        if token in '{[':
+            if depth == 1 and token == '[' and key == _FEATURES_KEY:
+                return match.end(), match.end(), (depth, expect_key, key)
+            depth += 1
+            expect_key = depth == 1 and token == '{'
+            key = None if depth == 1 else key
+        elif token in '}]':
+            depth -= 1
+        elif token == ',':
+            if depth == 1:
+                expect_key, key = True, None
+        elif depth == 1 and expect_key:
+            key, expect_key = token, False
+    return None, len(buffer), (depth, expect_key, key)
+
+
+def _scan_feature(buffer: str, start: int):
+    """
+    Find the end of the feature object starting at `buffer[start]` and the span of its properties.
+    Returns None if the buffer ends before the feature does.
+    """
+    depth = 0
+    key = None
+    props_start = None
+    props_end = None
+    for match in _TOKENS.finditer(buffer, start):
+        token = match.group()
+        if token == '{':
+            depth += 1
+            if depth == 2 and key == '"properties"' and props_start is None:
+                props_start = match.start()
+        elif token == '}':
+            depth -= 1
+            if depth == 1 and props_start is not None and props_end is None:
+                props_end = match.end()
+            elif depth == 0:
+                return match.end(), props_start, props_end
+        elif token == '"':
+            return None
+        elif depth == 1:
+            key = token
+    return None
+
+
+def iter_features(
+        filepath: str,
+        prop_name: str = None,
+        prop_list: Iterable = None,
+        chunk_size: int = 2**20,
+    ) -> Iterator[dict]:
+    """
+    Iterate over the features of a GeoJSON FeatureCollection file without loading the whole file.
+    If `prop_name` is given, only yield features where that property matches a value in `prop_list`.
+    The properties are checked before the rest of the feature is parsed,
+    so the geometries of other features are skipped without being decoded.
+    Memory is bounded by the chunk size and the largest feature.
+    """
+    prop_set = set(prop_list) if prop_name is not None else None
+    with open(filepath, 'r', encoding='utf-8') as f:
+        buffer = ''
+        start, pos, state = None, 0, (0, False, None)
+        while start is None:
+            chunk = f.read(chunk_size)
+            profiling.count("geojson.characters_read", len(chunk))
+            if not chunk:
+                raise Exception(f"No features found in {filepath}")
+            # only keep what is left to scan
+            buffer = buffer[pos:] + chunk
+            start, pos, state = _find_features_start(buffer, 0, state)
+        pos = start
+        read_size = chunk_size
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            result = None
+            if pos < len(buffer):
+                char = buffer[pos]
+                if char == ']':
+                    return
+                if char != '{':
+                    raise Exception(f"Unexpected character {char!r} in the features of {filepath}")
+                result = _scan_feature(buffer, pos)
+            if result is None:
+                chunk = f.read(read_size)
+                profiling.count("geojson.characters_read", len(chunk))
+                if not chunk:
+                    raise Exception(f"Unexpected end of file in {filepath}")
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                read_size *= 2 # avoid rescanning large features many times
+                continue
+            read_size = chunk_size
+            end, props_start, props_end = result
+            profiling.count("geojson.features_scanned")
+            if prop_set is None:
+                profiling.count("geojson.features_parsed")
+                yield json.loads(buffer[pos:end])
+            else:
+                properties = json.loads(buffer[props_start:props_end]) if props_start is not None else {}
+                if properties.get(prop_name) in prop_set:
+                    profiling.count("geojson.features_parsed")
+                    yield json.loads(buffer[pos:end])
+            pos = end
+            if pos >= chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def read_features(filepath: str, prop_name: str = None, prop_list: Iterable = None, **kwargs):
+    """
+    Return the features of a GeoJSON file that match at least one value in a list of values for a given property.
+    Streaming equivalent of loading the file and calling `filter_features_by_list`.
+    If `prop_name` is None all features are returned.
+    """
+    with profiling.stage("geojson.read_features", logger):
+        features = list(iter_features(filepath, prop_name, prop_list, **kwargs))
+    return features
+
+
 #--------------------------------#
 #     Shapely <> GeoJson
 #--------------------------------#
@@ -108,35 +298,158 @@ def convert_dict_to_shapely(geometry: dict, min_area: float = 0.0):
     return polygon
 
 
+def features_to_ragged(features: List[dict]):
+    """
+    Flatten the Polygon and MultiPolygon geometries of the features into contiguous arrays:
+    - `coords`: (n, 2) array of all vertices.
+    - `ring_offsets`: ring `i` is `coords[ring_offsets[i]:ring_offsets[i + 1]]`.
+    - `part_offsets`: polygon part `j` has rings `part_offsets[j]:part_offsets[j + 1]`. The first ring is the exterior.
+    - `feature_offsets`: feature `k` has parts `feature_offsets[k]:feature_offsets[k + 1]`.
+    - `is_multi`: whether each feature is a MultiPolygon.
+    """
+    rings = []
+    ring_counts = []
+    part_counts = []
+    is_multi = np.zeros(len(features), dtype=bool)
+    for idx, feature in enumerate(features):
+        geometry = feature['geometry']
+        geometry_type = geometry['type']
+        if geometry_type == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry_type == 'MultiPolygon':
+            parts = geometry['coordinates']
+            is_multi[idx] = True
+        else:
+            raise Exception(f"Type not supported: {geometry_type}")
+        part_counts.append(len(parts))
+        for part in parts:
+            ring_counts.append(len(part))
+            rings.extend(part)
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    ring_offsets[1:] = np.cumsum([len(ring) for ring in rings])
+    part_offsets = np.zeros(len(ring_counts) + 1, dtype=np.int64)
+    part_offsets[1:] = np.cumsum(ring_counts)
+    feature_offsets = np.zeros(len(features) + 1, dtype=np.int64)
+    feature_offsets[1:] = np.cumsum(part_counts)
+    if ring_offsets[-1] > 0:
+        coords = np.array(list(chain.from_iterable(rings)), dtype=float)[:, :2]
+    else:
+        coords = np.zeros((0, 2))
+    return coords, ring_offsets, part_offsets, feature_offsets, is_multi
+
+
+def convert_features_to_shapely(features: List[dict], min_area: float = 0.0):
+    """
+    Bulk equivalent of calling `convert_dict_to_shapely` on the geometry of every feature.
+    All polygon parts are created in one call and the `min_area` filter is applied to the MultiPolygon parts at once.
+    """
+    coords, ring_offsets, part_offsets, feature_offsets, is_multi = features_to_ragged(features)
+    geometries = np.full(len(features), None, dtype=object)
+    if len(features) == 0:
+        return geometries
+    parts = shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, (ring_offsets, part_offsets))
+    part_feature_ids = np.repeat(np.arange(len(features)), np.diff(feature_offsets))
+    part_is_multi = is_multi[part_feature_ids]
+    # polygons
+    single_idxs = np.flatnonzero(~is_multi)
+    geometries[single_idxs] = parts[feature_offsets[single_idxs]]
+    # multipolygons
+    keep = part_is_multi
+    if min_area > 0.0:
+        keep = keep & (shapely.area(parts) >= min_area)
+    if keep.any():
+        shapely.multipolygons(parts[keep], indices=part_feature_ids[keep], out=geometries)
+    empty_multi = is_multi & shapely.is_missing(geometries)
+    geometries[empty_multi] = [MultiPolygon() for _ in range(empty_multi.sum())]
+    return geometries
+
+
 def get_polygons(features, identifier='shapeName', **kwargs):
+    features = list(features)
     shapes = {}
-    for idx, feat in enumerate(features):
-        id = feat['properties'][identifier]
-        if (id in shapes):
-            new_id = f"{id}-{idx}"
-            logger.warning(f"Duplicate {identifier} '{id}'. Setting {identifier} to '{new_id}'.")
-            id = new_id
-            #raise Exception('Duplicate id: ' + id)
-        polygon = convert_dict_to_shapely(feat['geometry'], **kwargs)
-        shapes[id] = polygon
+    with profiling.stage("geojson.get_polygons", logger):
+        geometries = convert_features_to_shapely(features, **kwargs)
+        for idx, (feat, polygon) in enumerate(zip(features, geometries)):
+            id = feat['properties'][identifier]
+            if (id in shapes):
+                new_id = f"{id}-{idx}"
+                logger.warning(f"Duplicate {identifier} '{id}'. Setting {identifier} to '{new_id}'.")
+                id = new_id
+                #raise Exception('Duplicate id: ' + id)
+            shapes[id] = polygon
+    profiling.count("geojson.polygons", len(shapes))
     return shapes
 
 
-def convert_shapely_to_geojson_coords(shape: Union[Polygon, MultiPolygon]):
+def _polygon_to_geojson_coords(polygon: Polygon, precision: int = None):
+    rings = [polygon.exterior, *polygon.interiors]
+    coords = []
+    for ring in rings:
+        ring_coords = shapely.get_coordinates(ring)
+        if precision is not None:
+            ring_coords = np.round(ring_coords, precision)
+        coords.append(ring_coords.tolist())
+    return coords
+
+
+def convert_shapely_to_geojson_coords(shape: Union[Polygon, MultiPolygon], precision: int = None):
+    """
+    GeoJSON geometry type and coordinates of the shape.
+    If `precision` is given the coordinates are rounded to that many decimals.
+    """
     shape_type = type(shape)
     if shape_type == Polygon:
-        coords = [[list(xy) for xy in shape.exterior.coords]]
-        for hole in shape.interiors:
-            coords.append([list(xy) for xy in hole.coords])
+        coords = _polygon_to_geojson_coords(shape, precision=precision)
         type_str = 'Polygon'
     elif shape_type == MultiPolygon:
-        coords = []
-        for polygon in shape.geoms:
-            polygon_coords = [[list(xy) for xy in polygon.exterior.coords]]
-            for hole in polygon.interiors:
-                polygon_coords.append([list(xy) for xy in hole.coords])
-            coords.append(polygon_coords)
+        coords = [_polygon_to_geojson_coords(polygon, precision=precision) for polygon in shape.geoms]
         type_str = 'MultiPolygon'
     else:
         raise Exception(f"Type '{shape_type}' is not supported.")
     return type_str, coords
+
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def write_feature_collection(
+        filepath: str,
+        shapes: Dict[str, Union[Polygon, MultiPolygon]],
+        properties: Dict[str, Sequence] = None,
+        identifier: str = 'shapeName',
+        precision: int = None,
+    ):
+    """
+    Write the shapes to a GeoJSON FeatureCollection one feature at a time, so memory does not grow with the output.
+    The key of each shape is saved as the `identifier` property.
+    `properties` maps property names to values in the same order as `shapes`,
+    e.g. `{"density": densities, "population": population_counts, "area": areas}`.
+    Non-finite values are written as null.
+    """
+    properties = properties or {}
+    for prop_name, values in properties.items():
+        if len(values) != len(shapes):
+            raise Exception(f"Property '{prop_name}' has {len(values)} values for {len(shapes)} shapes")
+    with profiling.stage("geojson.write_feature_collection", logger):
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write('{"type": "FeatureCollection", "features": [\n')
+            for idx, (name, shape) in enumerate(shapes.items()):
+                type_str, coords = convert_shapely_to_geojson_coords(shape, precision=precision)
+                feature_properties = {identifier: name}
+                for prop_name, values in properties.items():
+                    feature_properties[prop_name] = _to_json_value(values[idx])
+                feature = {
+                    "type": "Feature",
+                    "properties": feature_properties,
+                    "geometry": {"type": type_str, "coordinates": coords},
+                }
+                if idx > 0:
+                    f.write(',\n')
+                f.write(json.dumps(feature))
+            f.write('\n]}\n')
+    profiling.count("geojson.features_written", len(shapes))
@@ -0,0 +1,162 @@
+"""
+Distribution of people by the density of the pixel they live in.
+Histograms use fixed logarithmic bins so partial histograms of chunks, rows or workers can be merged exactly.
+"""
+import logging
+import numpy as np
+import rasterio
+import rasterio.features
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window
+from shapely import MultiPolygon, Polygon
+from typing import List, Union
+
+from utilities import profiling
+from utilities.area import EARTH_RADIUS, calc_pixel_areas, iter_masked_strips
+
+logger = logging.getLogger(__name__)
+
+
+class DensityHistogram:
+    """
+    Population, area and pixel count per density bin, with the edges spaced evenly in log10(people/km^2).
+    The first bin collects densities below `min_density`, including unpopulated pixels,
+    and the last bin densities above `max_density`.
+    """
+    def __init__(self, min_density: float = 1.0, max_density: float = 1e6, bins_per_decade: int = 10):
+        num_bins = int(round(np.log10(max_density / min_density) * bins_per_decade))
+        self.edges = np.logspace(np.log10(min_density), np.log10(max_density), num_bins + 1)
+        self.population = np.zeros(num_bins + 2)
+        self.area = np.zeros(num_bins + 2) # metres^2
+        self.pixels = np.zeros(num_bins + 2, dtype=np.int64)
+        self.weighted_density = 0.0 # sum of population * density
+
+    def add(self, population: np.ndarray, pixel_areas: np.ndarray):
+        """
+        Add pixels with their population and area in metres^2. Negative (nodata) populations count as 0.
+        """
+        population = np.asarray(population, dtype=np.float64).ravel()
+        pixel_areas = np.broadcast_to(pixel_areas, population.shape).astype(np.float64)
+        population = np.where(population > 0, population, 0)
+        densities = population / (pixel_areas/1e6) # people/km^2
+        bins = np.searchsorted(self.edges, densities, side='right')
+        num_bins = len(self.population)
+        self.population += np.bincount(bins, weights=population, minlength=num_bins)
+        self.area += np.bincount(bins, weights=pixel_areas, minlength=num_bins)
+        self.pixels += np.bincount(bins, minlength=num_bins)
+        self.weighted_density += float(population @ densities)
+        return self
+
+    def merge(self, other: "DensityHistogram"):
+        """
+        Add the counts of a histogram with the same bins, e.g. from another chunk or worker.
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms with different bins cannot be merged")
+        self.population += other.population
+        self.area += other.area
+        self.pixels += other.pixels
+        self.weighted_density += other.weighted_density
+        return self
+
+    @property
+    def total_population(self) -> float:
+        return float(self.population.sum())
+
+    @property
+    def total_area(self) -> float:
+        return float(self.area.sum())
+
+    def mean_density(self) -> float:
+        """
+        Population over area in people/km^2, as reported by `show_stats`.
+        """
+        return self.total_population / (self.total_area/1e6)
+
+    def population_weighted_density(self) -> float:
+        """
+        Density experienced by the average person in people/km^2.
+        """
+        return self.weighted_density / self.total_population if self.total_population else 0.0
+
+    def quantile(self, q: float) -> float:
+        """
+        Density in people/km^2 below which a fraction `q` of the population lives,
+        interpolated in log space within the bins. Limited to the range of the edges.
+        """
+        cumulative = np.cumsum(self.population[1:-1]) + self.population[0]
+        target = q * self.total_population
+        idx = int(np.searchsorted(cumulative, target))
+        if idx >= len(cumulative):
+            return float(self.edges[-1])
+        previous = cumulative[idx - 1] if idx > 0 else self.population[0]
+        if target <= previous:
+            return float(self.edges[idx])
+        fraction = (target - previous) / (cumulative[idx] - previous)
+        log_edges = np.log10(self.edges)
+        return float(10 ** (log_edges[idx] + fraction * (log_edges[idx + 1] - log_edges[idx])))
+
+    def summary(self) -> dict:
+        return {
+            "population": self.total_population,
+            "area": self.total_area,
+            "mean_density": self.mean_density(),
+            "weighted_density": self.population_weighted_density(),
+            "median_density": self.quantile(0.5),
+        }
+
+
+def get_density_histogram(
+        population_data: rasterio.io.DatasetReader,
+        geometries: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS,
+        max_bytes: int = 256 * 2**20,
+        window: Window = None,
+        **kwargs
+    ) -> DensityHistogram:
+    """
+    Density histogram of the pixels whose centres lie inside the geometries, walking the raster with
+    `iter_masked_strips` so memory is bounded by `max_bytes` and not by the size of the region.
+    Other keyword arguments set the bins of the `DensityHistogram`.
+    """
+    histogram = DensityHistogram(**kwargs)
+    with profiling.stage("histogram.get_density_histogram", logger):
+        for strip, mask, strip_window in iter_masked_strips(population_data, geometries, max_bytes, window=window):
+            row_areas = calc_pixel_areas(population_data.transform, strip_window.row_off, strip.shape[0], radius=radius)
+            rows, _ = np.nonzero(mask)
+            histogram.add(strip[mask], row_areas[rows])
+    return histogram
+
+
+def _get_band_histogram(raster_filepath: str, geometries: list, window: Window, kwargs: dict):
+    with rasterio.open(raster_filepath) as src:
+        return get_density_histogram(src, geometries, window=window, **kwargs)
+
+
+def get_density_histogram_parallel(
+        raster_filepath: str,
+        geometries: List[Union[Polygon, MultiPolygon]],
+        workers: int = None,
+        num_bands: int = None,
+        **kwargs
+    ) -> DensityHistogram:
+    """
+    Same as `get_density_histogram` with the window covering the geometries split into bands of rows.
+    Each band is processed by a worker process and the partial histograms are merged.
+    """
+    with rasterio.open(raster_filepath) as src:
+        window = rasterio.features.geometry_window(src, geometries)
+    height = int(window.height)
+    num_bands = min(num_bands or (workers or 4) * 2, height)
+    band_edges = np.linspace(0, height, num_bands + 1).astype(int)
+    bands = [
+        Window(window.col_off, window.row_off + start, window.width, stop - start)
+        for start, stop in zip(band_edges[:-1], band_edges[1:]) if stop > start
+    ]
+    histogram = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_get_band_histogram, raster_filepath, geometries, band, kwargs) for band in bands]
+        for future in futures:
+            partial = future.result()
+            histogram = partial if histogram is None else histogram.merge(partial)
+    return histogram
@@ -0,0 +1,247 @@
+"""
+Summed-area tables (integral images) of population rasters for constant time window sums.
+The table of a raster with shape (height, width) is a float64 array S of shape (height + 1, width + 1)
+where S[i, j] is the population of the pixels above row i and left of column j. It is stored next to the raster
+as `<name>.sat.npy` with a JSON sidecar and memory-mapped, so only the rows a query touches are read.
+Note the table takes 8 bytes per pixel, e.g. about 1 GB for a 10,000 x 12,000 pixel raster.
+"""
+import json
+import logging
+import numpy as np
+import os
+import rasterio
+from rasterio import Affine
+from rasterio.windows import Window
+from typing import List
+
+from utilities import profiling
+from utilities.area import EARTH_RADIUS, calc_pixel_areas
+from utilities.cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+def get_integral_filepaths(raster_filepath: str):
+    root, _ = os.path.splitext(raster_filepath)
+    return f"{root}.sat.npy", f"{root}.sat.json"
+
+
+class IntegralImage:
+    """
+    Read only summed-area table of a raster with its transform.
+    """
+    def __init__(self, table: np.ndarray, transform: Affine, crs=None):
+        self.table = table
+        self.transform = transform
+        self.crs = crs
+        self.height = table.shape[0] - 1
+        self.width = table.shape[1] - 1
+
+    @classmethod
+    def load(cls, filepath: str, meta_filepath: str):
+        with open(meta_filepath, 'r') as f:
+            meta = json.load(f)
+        table = np.load(filepath, mmap_mode='r')
+        return cls(table, Affine(*meta["transform"]), meta["crs"])
+
+    def sum_window(self, row_start: int, row_stop: int, col_start: int, col_stop: int) -> float:
+        """
+        Population of the pixels in rows `row_start` to `row_stop` and columns `col_start` to `col_stop` (exclusive).
+        """
+        S = self.table
+        return float(S[row_stop, col_stop] - S[row_start, col_stop] - S[row_stop, col_start] + S[row_start, col_start])
+
+    def sum_windows(self, row_starts, row_stops, col_starts, col_stops) -> np.ndarray:
+        """
+        Vectorized `sum_window` for arrays of windows.
+        """
+        S = self.table
+        row_starts, row_stops = np.asarray(row_starts), np.asarray(row_stops)
+        col_starts, col_stops = np.asarray(col_starts), np.asarray(col_stops)
+        return S[row_stops, col_stops] - S[row_starts, col_stops] - S[row_stops, col_starts] + S[row_starts, col_starts]
+
+    def bounds_to_window(self, left: float, bottom: float, right: float, top: float) -> Window:
+        """
+        Window of the pixels whose centres lie inside the bounds, clipped to the raster.
+        """
+        inverse = ~self.transform
+        cols = sorted([(inverse * (left, top))[0], (inverse * (right, bottom))[0]])
+        rows = sorted([(inverse * (left, top))[1], (inverse * (right, bottom))[1]])
+        col_start = min(max(0, int(np.ceil(cols[0] - 0.5))), self.width)
+        col_stop = min(max(0, int(np.floor(cols[1] - 0.5)) + 1), self.width)
+        row_start = min(max(0, int(np.ceil(rows[0] - 0.5))), self.height)
+        row_stop = min(max(0, int(np.floor(rows[1] - 0.5)) + 1), self.height)
+        return Window(col_start, row_start, max(0, col_stop - col_start), max(0, row_stop - row_start))
+
+    def sum_bounds(self, left: float, bottom: float, right: float, top: float) -> float:
+        """
+        Population of the pixels whose centres lie inside the bounds, e.g. from `projection.calc_square_boundary`.
+        """
+        window = self.bounds_to_window(left, bottom, right, top)
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        return self.sum_window(row_start, row_start + int(window.height), col_start, col_start + int(window.width))
+
+    def get_window_shape(self, height: float, width: float, lat: float = None, radius: float = EARTH_RADIUS):
+        """
+        Shape in pixels of a window of `height` x `width` metres at the latitude `lat` of a raster in degrees,
+        by default the latitude of the middle of the raster. E.g. `get_window_shape(1000, 1000)` for 1 km^2.
+        """
+        if lat is None:
+            lat = self.transform.f + self.transform.e * self.height / 2
+        pixel_height = abs(self.transform.e) * np.pi / 180 * radius
+        pixel_width = abs(self.transform.a) * np.pi / 180 * radius * np.cos(np.deg2rad(lat))
+        return max(1, int(round(height / pixel_height))), max(1, int(round(width / pixel_width)))
+
+    def top_k_windows(
+            self,
+            window_height: int,
+            window_width: int,
+            k: int = 10,
+            max_bytes: int = 256 * 2**20,
+            radius: float = EARTH_RADIUS,
+        ) -> List[dict]:
+        """
+        The `k` most populated non-overlapping windows of `window_height` x `window_width` pixels, chosen greedily:
+        the most populated window first, then the most populated window which does not overlap it and so on.
+        The sums of all window positions are computed in strips of rows bounded by `max_bytes` and only the
+        `num_candidates` largest are kept. The greedy choice among them is exact as long as it does not run out of
+        candidates, otherwise it is repeated with twice as many.
+        Each result has the population, the area in metres^2 and density in people/km^2, the pixel window and its bounds.
+        For a raster in degrees the density accounts for the pixel areas changing with latitude.
+        """
+        num_rows = self.height - window_height + 1
+        num_cols = self.width - window_width + 1
+        if num_rows <= 0 or num_cols <= 0:
+            raise ValueError(f"Window of {window_height} x {window_width} pixels is larger than the raster")
+        # enough for every chosen window to exclude its whole neighbourhood of positions, within reason
+        num_candidates = min(k * (2 * window_height - 1) * (2 * window_width - 1), 2**20)
+        with profiling.stage("integral.top_k_windows", logger):
+            while True:
+                values, rows, cols, truncated = self._get_candidates(window_height, window_width, num_candidates, max_bytes)
+                selected = _select_non_overlapping(values, rows, cols, window_height, window_width, k)
+                if len(selected) == k or not truncated:
+                    break
+                num_candidates *= 2
+        results = []
+        for value, row, col in selected:
+            window = Window(int(col), int(row), window_width, window_height)
+            area = calc_pixel_areas(self.transform, int(row), window_height, radius=radius).sum() * window_width
+            results.append({
+                "population": float(value),
+                "area": float(area),
+                "density": float(value / (area/1e6)),
+                "window": window,
+                "bounds": rasterio.windows.bounds(window, self.transform),
+            })
+        return results
+
+    def _get_candidates(self, window_height: int, window_width: int, num_candidates: int, max_bytes: int):
+        """
+        Sums and positions of the `num_candidates` most populated windows, in decreasing order of population,
+        and whether any populated window was left out.
+        """
+        num_rows = self.height - window_height + 1
+        num_cols = self.width - window_width + 1
+        strip_rows = max(1, max_bytes // (8 * (self.width + 1) * 4) - window_height)
+        values, positions = [np.zeros(0)], [np.zeros(0, dtype=np.int64)]
+        num_buffered = 0
+        truncated = False
+
+        def keep_best(values, positions):
+            values, positions = np.concatenate(values), np.concatenate(positions)
+            if len(values) > num_candidates:
+                best = np.argpartition(-values, num_candidates)[:num_candidates]
+                return [values[best]], [positions[best]], True
+            return [values], [positions], False
+
+        for row_start in range(0, num_rows, strip_rows):
+            row_stop = min(row_start + strip_rows, num_rows)
+            top = np.asarray(self.table[row_start:row_stop])
+            bottom = np.asarray(self.table[row_start + window_height:row_stop + window_height])
+            sums = ((bottom[:, window_width:] - top[:, window_width:]) - (bottom[:, :num_cols] - top[:, :num_cols])).ravel()
+            strip_positions = np.flatnonzero(sums > 0)
+            values.append(sums[strip_positions])
+            positions.append(strip_positions + row_start * num_cols)
+            num_buffered += len(strip_positions)
+            # only trim the candidates once the buffer is well over the limit
+            if num_buffered > 2 * num_candidates:
+                values, positions, dropped = keep_best(values, positions)
+                truncated |= dropped
+                num_buffered = len(values[0])
+        values, positions, dropped = keep_best(values, positions)
+        truncated |= dropped
+        values, positions = values[0], positions[0]
+        order = np.argsort(-values, kind='stable')
+        values, positions = values[order], positions[order]
+        return values, positions // num_cols, positions % num_cols, truncated
+
+
+def _select_non_overlapping(values: np.ndarray, rows: np.ndarray, cols: np.ndarray, height: int, width: int, k: int):
+    """
+    Greedily choose up to `k` windows of `height` x `width` pixels which do not overlap,
+    from candidates sorted in decreasing order of `values`.
+    """
+    available = np.ones(len(values), dtype=bool)
+    selected = []
+    while len(selected) < k and available.any():
+        idx = int(np.argmax(available))
+        row, col = rows[idx], cols[idx]
+        selected.append((values[idx], row, col))
+        available &= (np.abs(rows - row) >= height) | (np.abs(cols - col) >= width)
+    return selected
+
+
+def build_integral_image(
+        raster_filepath: str,
+        filepath: str = None,
+        meta_filepath: str = None,
+        max_bytes: int = 256 * 2**20,
+    ) -> IntegralImage:
+    """
+    Build the summed-area table of the first band of a raster, reading strips of rows bounded by `max_bytes`.
+    Nodata and negative pixels are counted as 0.
+    The table is written to a temporary file and then moved into place, followed by the JSON sidecar.
+    """
+    default_filepath, default_meta_filepath = get_integral_filepaths(raster_filepath)
+    filepath = filepath or default_filepath
+    meta_filepath = meta_filepath or default_meta_filepath
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp.npy"
+    with rasterio.open(raster_filepath) as src:
+        table = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=np.float64, shape=(src.height + 1, src.width + 1))
+        table[0, :] = 0
+        table[:, 0] = 0
+        strip_rows = max(1, max_bytes // (src.width * 16))
+        with profiling.stage("integral.build", logger):
+            for row_start in range(0, src.height, strip_rows):
+                height = min(strip_rows, src.height - row_start)
+                strip = src.read(1, window=Window(0, row_start, src.width, height)).astype(np.float64)
+                invalid = ~np.isfinite(strip) | (strip < 0)
+                if src.nodata is not None:
+                    invalid |= strip == src.nodata
+                strip[invalid] = 0
+                np.cumsum(strip, axis=1, out=strip)
+                np.cumsum(strip, axis=0, out=strip)
+                table[row_start + 1:row_start + height + 1, 1:] = strip + table[row_start, 1:]
+                profiling.count("raster.pixels_read", strip.size)
+        table.flush()
+        meta = {
+            "transform": list(src.transform)[:6],
+            "crs": src.crs.to_wkt() if src.crs else None,
+            "height": src.height,
+            "width": src.width,
+        }
+    del table
+    os.replace(tmp_filepath, filepath)
+    write_atomic(meta_filepath, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    logger.info(f"Saved summed-area table to {filepath}")
+    return IntegralImage.load(filepath, meta_filepath)
+
+
+def open_integral_image(raster_filepath: str, **kwargs) -> IntegralImage:
+    """
+    Load the summed-area table stored next to a raster, building it first if it is missing or older than the raster.
+    """
+    filepath, meta_filepath = get_integral_filepaths(raster_filepath)
+    if os.path.isfile(meta_filepath) and os.path.getmtime(meta_filepath) >= os.path.getmtime(raster_filepath):
+        return IntegralImage.load(filepath, meta_filepath)
+    return build_integral_image(raster_filepath, filepath, meta_filepath, **kwargs)
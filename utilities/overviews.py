@@ -0,0 +1,184 @@
+"""
+Count-preserving overview pyramids for population rasters.
+Each level halves the resolution of the previous one by summing blocks of 2x2 pixels,
+so the total population of any aligned region is the same at every level.
+Levels are stored next to the raster as `<name>.x<factor>.tif`, e.g. `ppp_2020.x8.tif`.
+"""
+import logging
+import numpy as np
+import os
+import rasterio
+from rasterio import Affine
+from rasterio.windows import Window
+from typing import List, Tuple
+
+from utilities import profiling
+
+logger = logging.getLogger(__name__)
+
+NODATA = -99999
+BLOCK_SIZE = 256
+
+
+def get_overview_filepath(raster_filepath: str, factor: int) -> str:
+    root, ext = os.path.splitext(raster_filepath)
+    return f"{root}.x{factor}{ext or '.tif'}"
+
+
+def reduce_sum(data: np.ndarray, nodata: float = None, factor: int = 2) -> np.ndarray:
+    """
+    Sum blocks of `factor` x `factor` pixels in float64.
+    Nodata and negative pixels count as 0. Blocks without any valid pixel are set to `NODATA`.
+    Edges which are not a multiple of the factor are padded with invalid pixels.
+    """
+    valid = np.isfinite(data) & (data >= 0)
+    if nodata is not None:
+        valid &= data != nodata
+    height, width = data.shape
+    out_height, out_width = -(-height // factor), -(-width // factor)
+    values = np.zeros((out_height * factor, out_width * factor), dtype=np.float64)
+    counts = np.zeros(values.shape, dtype=bool)
+    values[:height, :width] = np.where(valid, data, 0)
+    counts[:height, :width] = valid
+    values = values.reshape(out_height, factor, out_width, factor).sum(axis=(1, 3))
+    counts = counts.reshape(out_height, factor, out_width, factor).any(axis=(1, 3))
+    values[~counts] = NODATA
+    return values
+
+
+def _get_level_profile(src: rasterio.io.DatasetReader, factor: int) -> dict:
+    width, height = -(-src.width // factor), -(-src.height // factor)
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': src.crs,
+        'transform': src.transform * Affine.scale(factor),
+        'nodata': NODATA,
+        'compress': 'lzw',
+    }
+    if width >= BLOCK_SIZE and height >= BLOCK_SIZE:
+        profile.update({'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE})
+    return profile
+
+
+def build_level(src: rasterio.io.DatasetReader, filepath: str, factor: int = 2, max_pixels: int = 2**24):
+    """
+    Write `src` reduced by `factor` to `filepath`, reading strips of at most `max_pixels` source pixels.
+    The file is written to a temporary path first and then moved into place.
+    """
+    profile = _get_level_profile(src, factor)
+    strip_rows = max(1, max_pixels // (src.width * factor)) * factor
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with rasterio.open(tmp_filepath, 'w', **profile) as dst:
+        for row_start in range(0, src.height, strip_rows):
+            height = min(strip_rows, src.height - row_start)
+            strip = src.read(1, window=Window(0, row_start, src.width, height))
+            reduced = reduce_sum(strip, nodata=src.nodata, factor=factor)
+            dst.write(reduced.astype(np.float32), 1, window=Window(0, row_start // factor, *reduced.shape[::-1]))
+            profiling.count("overviews.pixels_read", strip.size)
+    os.replace(tmp_filepath, filepath)
+
+
+def get_level_factors(width: int, height: int, max_factor: int = 64, min_size: int = 16) -> List[int]:
+    """
+    Factors of the levels `build_overviews` builds for a raster of `width` x `height` pixels:
+    2, 4, 8, ... up to `max_factor`, stopping once a level would be smaller than `min_size` pixels on a side.
+    """
+    factors = []
+    factor = 2
+    while factor <= max_factor and min(width, height) >= 2 * min_size:
+        factors.append(factor)
+        width, height = -(-width // 2), -(-height // 2)
+        factor *= 2
+    return factors
+
+
+def build_overviews(raster_filepath: str, max_factor: int = 64, min_size: int = 16, max_pixels: int = 2**24) -> List[int]:
+    """
+    Build the overview levels 2x, 4x, 8x, ... up to `max_factor` for a raster.
+    Each level is built from the one before it, so the full resolution raster is only read once.
+    Stops early once a level would be smaller than `min_size` pixels on a side. Returns the factors built.
+    """
+    with rasterio.open(raster_filepath) as src:
+        factors = get_level_factors(src.width, src.height, max_factor=max_factor, min_size=min_size)
+    source_filepath = raster_filepath
+    with profiling.stage("overviews.build", logger):
+        for factor in factors:
+            filepath = get_overview_filepath(raster_filepath, factor)
+            with rasterio.open(source_filepath) as src:
+                build_level(src, filepath, factor=2, max_pixels=max_pixels)
+            logger.info(f"Saved {factor}x overview to {filepath}")
+            source_filepath = filepath
+    return factors
+
+
+def get_overview_factors(raster_filepath: str) -> List[int]:
+    """
+    Factors of the overview levels available for a raster, including 1 for the raster itself.
+    Levels older than the raster are ignored.
+    """
+    mtime = os.path.getmtime(raster_filepath)
+    factors = [1]
+    factor = 2
+    while True:
+        filepath = get_overview_filepath(raster_filepath, factor)
+        if not os.path.isfile(filepath) or os.path.getmtime(filepath) < mtime:
+            break
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def choose_overview_factor(pixel_size: float, resolution: float, factors: List[int]) -> int:
+    """
+    The largest factor whose pixels are no larger than `resolution`, in the same units as `pixel_size`.
+    """
+    candidates = [factor for factor in factors if factor * pixel_size <= resolution * (1 + 1e-9)]
+    return max(candidates) if candidates else min(factors)
+
+
+def open_overview(raster_filepath: str, resolution: float = None) -> Tuple[rasterio.io.DatasetReader, int]:
+    """
+    Open the coarsest level of the raster with pixels no larger than `resolution`, in the units of the raster's CRS.
+    Returns the dataset and its factor. Without a resolution the full resolution raster is opened.
+    """
+    factor = 1
+    if resolution is not None:
+        with rasterio.open(raster_filepath) as src:
+            pixel_size = max(abs(src.transform.a), abs(src.transform.e))
+        factor = choose_overview_factor(pixel_size, resolution, get_overview_factors(raster_filepath))
+    filepath = raster_filepath if factor == 1 else get_overview_filepath(raster_filepath, factor)
+    logger.debug(f"Using {factor}x level for a resolution of {resolution}")
+    return rasterio.open(filepath), factor
+
+
+def _get_pixel_bounds(src: rasterio.io.DatasetReader, bounds: Tuple[float, float, float, float]):
+    window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    row_start = max(0, int(np.floor(window.row_off)))
+    col_start = max(0, int(np.floor(window.col_off)))
+    row_stop = min(src.height, int(np.ceil(window.row_off + window.height)))
+    col_stop = min(src.width, int(np.ceil(window.col_off + window.width)))
+    if row_start >= row_stop or col_start >= col_stop:
+        raise ValueError(f"Bounds {bounds} do not overlap the raster")
+    return row_start, row_stop, col_start, col_stop
+
+
+def read_overview(raster_filepath: str, resolution: float, bounds: Tuple[float, float, float, float] = None):
+    """
+    Read the region `bounds` = (left, bottom, right, top) from the coarsest level with pixels no larger than `resolution`.
+    The region is expanded to whole pixels of that level and clipped to the raster.
+    Returns the image, its transform and the factor of the level. Nodata pixels are left as they are.
+    """
+    src, factor = open_overview(raster_filepath, resolution)
+    with src:
+        window = Window(0, 0, src.width, src.height)
+        if bounds is not None:
+            row_start, row_stop, col_start, col_stop = _get_pixel_bounds(src, bounds)
+            window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        img = src.read(1, window=window)
+        transform = src.window_transform(window)
+    profiling.count("overviews.pixels_read", img.size)
+    return img, transform, factor
@@ -1,7 +1,14 @@
+import logging
+import matplotlib.collections
 import numpy as np
+import shapely
 from shapely import Polygon, MultiPolygon
 from typing import List
 
+from utilities import profiling
+
+logger = logging.getLogger(__name__)
+
 # -------------------------------------------#
 #                 Ticks
 # -------------------------------------------#
@@ -82,11 +89,72 @@ def plot_polygon(axes, geometry, *args, offset: np.array = np.array([0, 0]), **k
 
 
 def plot_polygons(axes, polygons: List, *args, **kwargs):
-    for idx, geometry in enumerate(polygons):
-        plot_polygon(axes, geometry, *args, **kwargs)
+    with profiling.stage("plotting.plot_polygons", logger):
+        for idx, geometry in enumerate(polygons):
+            plot_polygon(axes, geometry, *args, **kwargs)
+            profiling.count("plotting.polygons")
     return axes
 
 
+def apply_transform(transform, coords: np.ndarray) -> np.ndarray:
+    """
+    Apply an affine transform to an (n, 2) array of coordinates at once.
+    """
+    a, b, c, d, e, f = transform[:6]
+    xs, ys = coords[:, 0], coords[:, 1]
+    return np.column_stack((a * xs + b * ys + c, d * xs + e * ys + f))
+
+
+def get_exterior_rings(geometries: List, transform=None, offset: np.array = np.array([0, 0])):
+    """
+    Exterior rings of all Polygon parts of the geometries as a list of (n, 2) arrays,
+    and the index of the geometry each ring belongs to. Other parts, such as lines in a collection, are skipped.
+    The transform and offset are applied to all coordinates together.
+    """
+    geometries = np.asarray(list(geometries), dtype=object)
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, index = parts[is_polygon], index[is_polygon]
+    exteriors = shapely.get_exterior_ring(parts)
+    coords = shapely.get_coordinates(exteriors)
+    if transform is not None:
+        coords = apply_transform(transform, coords)
+    coords = coords + offset
+    ring_ends = np.cumsum(shapely.get_num_coordinates(exteriors))
+    rings = np.split(coords, ring_ends[:-1]) if len(parts) else []
+    return rings, index
+
+
+def plot_polygons_collection(
+        axes, geometries: List, transform=None,
+        values: List[float] = None,
+        offset: np.array = np.array([0, 0]),
+        **kwargs
+    ):
+    """
+    Plot the exterior rings of all geometries as one collection and return it.
+    Without values the rings are drawn as a LineCollection. With one value per geometry
+    they are filled as a PolyCollection coloured by value, e.g. with `cmap`, `edgecolor` and `linewidth` in kwargs.
+    Keyword arguments are passed to the collection.
+    """
+    geometries = list(geometries)
+    with profiling.stage("plotting.plot_polygons_collection", logger):
+        rings, index = get_exterior_rings(geometries, transform=transform, offset=offset)
+        if values is None:
+            collection = matplotlib.collections.LineCollection(rings, **kwargs)
+        else:
+            values = np.asarray(values)
+            if len(values) != len(geometries):
+                raise Exception(f"Expected {len(geometries)} values, got {len(values)}")
+            collection = matplotlib.collections.PolyCollection(rings, **kwargs)
+            collection.set_array(values[index])
+        axes.add_collection(collection)
+        axes.autoscale_view()
+        profiling.count("plotting.polygons", len(geometries))
+        profiling.count("plotting.vertices", sum(len(ring) for ring in rings))
+    return collection
+
+
 def plot_polygon_transform(
     axes, geometry, transform, *args, offset: np.array = np.array([0, 0]), **kwargs
     ):
@@ -97,10 +165,9 @@ def plot_polygon_transform(
     else:
         raise Exception(f'Geometry of type \'{type(geometry)}\' is not supported')
     for polygon in polygons:
-        transformed_poly = [transform * coords + offset for coords in polygon.exterior.coords]
-        xs = [coords[0] for coords in transformed_poly]
-        ys = [coords[1] for coords in transformed_poly]
-        axes.plot(xs, ys, *args, **kwargs)
+        coords = apply_transform(transform, np.asarray(polygon.exterior.coords)) + offset
+        profiling.count("plotting.vertices", len(coords))
+        axes.plot(coords[:, 0], coords[:, 1], *args, **kwargs)
     return axes
 
 
@@ -109,6 +176,8 @@ def plot_polygons_transform(
         transform, *args,
         offset: np.array = np.array([0, 0]),
     **kwargs):
-    for geom in geometries:
-        plot_polygon_transform(axes, geom, transform, *args, offset=offset, **kwargs)
+    with profiling.stage("plotting.plot_polygons_transform", logger):
+        for geom in geometries:
+            plot_polygon_transform(axes, geom, transform, *args, offset=offset, **kwargs)
+            profiling.count("plotting.polygons")
     return axes
@@ -0,0 +1,111 @@
+"""
+Opt-in stage timings and counters for the utilities.
+Disabled by default, in which case `stage` returns a shared no-op context manager and `count` returns immediately.
+
+Usage:
+    from utilities import profiling
+    profiling.enable()
+    ... # run a city
+    profiling.log_report()
+    profiling.save_report('report.json')
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_stages = {}
+_counters = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('name', 'logger', 'start')
+
+    def __init__(self, name: str, logger: logging.Logger = None):
+        self.name = name
+        self.logger = logger
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        record = _stages.get(self.name)
+        if record is None:
+            record = _stages[self.name] = {"calls": 0, "time": 0.0}
+        record["calls"] += 1
+        record["time"] += elapsed
+        if self.logger is not None:
+            self.logger.debug(f"{self.name}: {elapsed:.4f}s")
+        return False
+
+
+def stage(name: str, logger: logging.Logger = None):
+    """
+    Context manager that adds the wall time of its block to the stage `name`.
+    If a logger is given the time is also logged at DEBUG level.
+    Stages may be nested, in which case the outer time includes the inner time.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, logger)
+
+
+def count(name: str, value: int = 1):
+    """
+    Add `value` to the counter `name`, e.g. polygons processed, vertices touched, pixels read or bytes decoded.
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_report() -> dict:
+    return {
+        "stages": {name: dict(record) for name, record in _stages.items()},
+        "counters": dict(_counters),
+    }
+
+
+def save_report(filepath: str):
+    with open(filepath, 'w') as f:
+        json.dump(get_report(), f, indent=2)
+
+
+def log_report(report_logger: logging.Logger = logger, level: int = logging.INFO):
+    for name, record in sorted(_stages.items(), key=lambda item: -item[1]["time"]):
+        report_logger.log(level, f"{name:40s} {record['calls']:8d} calls {record['time']:10.4f}s")
+    for name, value in sorted(_counters.items()):
+        report_logger.log(level, f"{name:40s} {value:,}")
@@ -0,0 +1,86 @@
+import numpy as np
+import rasterio
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.warp import Resampling, calculate_default_transform, transform_geom
+from shapely import MultiPolygon, Polygon
+from typing import Dict, Union
+
+from utilities.area import EARTH_RADIUS
+from utilities.geojson import convert_dict_to_shapely
+
+WGS84_CRS = CRS.from_epsg(4326)
+
+
+def get_transverse_mercator_crs(long: float):
+    """
+    Transverse mercator projection centred on the longitude in degrees, with units of kilometres.
+    """
+    return {
+        'proj': 'tmerc',
+        'lat_0': 0,
+        'lon_0': long,
+        'k': 1/1000, # convert to km
+        'x_0': 0,
+        'y_0': 0,
+        'ellps': 'WGS84',
+        'units': 'm',
+        'no_defs': True
+    }
+
+
+def transverse_mercator_projection(polygons: Dict[str, Union[Polygon, MultiPolygon]], long: float):
+    """
+    Project longitude/latitude polygons onto the transverse mercator projection centred on `long`.
+    """
+    polygons_dst = transform_geom(
+        WGS84_CRS,
+        get_transverse_mercator_crs(long),
+        polygons.values()
+    )
+    polygons_dst = {
+        name: convert_dict_to_shapely(geom) for name, geom in zip(polygons.keys(), polygons_dst)
+    }
+    return polygons_dst
+
+
+def calc_square_boundary(polygon: Union[Polygon, MultiPolygon], length: float, radius: float = EARTH_RADIUS):
+    """
+    Bounds in degrees of a square with sides of `length` metres centred on the middle of the polygon's bounds.
+    """
+    long_min, lat_min, long_max, lat_max = polygon.bounds
+    long_avg = (long_min + long_max) / 2
+    lat_avg = (lat_max + lat_min) / 2
+    half_length = length / 2
+    lat_unit = half_length / radius * (180 / np.pi)
+    long_unit = half_length / (radius * np.cos(lat_avg * np.pi / 180)) * (180 / np.pi)
+    return (long_avg - long_unit, lat_avg - lat_unit, long_avg + long_unit, lat_avg + lat_unit)
+
+
+def reproject_image(
+        img: np.ndarray,
+        transform,
+        src_crs,
+        dst_crs,
+        bounds: tuple,
+        resolution: float = None,
+        resampling: Resampling = Resampling.bilinear,
+    ):
+    """
+    Reproject a 2D image covering `bounds` onto the `dst_crs` with the default transform.
+    Returns the projected image and its transform.
+    """
+    height, width = img.shape
+    transform_dst, width_dst, height_dst = calculate_default_transform(
+        src_crs, dst_crs, width, height, *bounds, resolution=resolution)
+    img_dst = np.zeros((height_dst, width_dst))
+    rasterio.warp.reproject(
+        source=img,
+        destination=img_dst,
+        src_transform=transform,
+        src_crs=src_crs,
+        dst_transform=transform_dst,
+        dst_crs=dst_crs,
+        resampling=resampling
+    )
+    return img_dst, transform_dst
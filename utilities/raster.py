@@ -0,0 +1,330 @@
+import json
+import logging
+import numpy as np
+import os
+import rasterio
+import rasterio.errors
+import rasterio.features
+import rasterio.windows
+from collections import OrderedDict
+from rasterio import Affine
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.transform import array_bounds
+from rasterio.windows import Window
+from shapely import MultiPolygon, Polygon
+from typing import List, Union
+
+from utilities import profiling
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------#
+#                 Tile cache
+# -------------------------------------------#
+
+
+class TileCache:
+    """
+    Least recently used cache of decoded raster blocks, bounded by the total number of bytes.
+    """
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def get(self, key):
+        tile = self._tiles.get(key)
+        if tile is None:
+            self.misses += 1
+            return None
+        self._tiles.move_to_end(key)
+        self.hits += 1
+        return tile
+
+    def put(self, key, tile: np.ndarray):
+        if key in self._tiles:
+            self.nbytes -= self._tiles.pop(key).nbytes
+        if tile.nbytes > self.max_bytes:
+            return
+        tile.flags.writeable = False
+        self._tiles[key] = tile
+        self.nbytes += tile.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._tiles.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "tiles": len(self._tiles),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+SHARED_TILE_CACHE = TileCache()
+
+
+# -------------------------------------------#
+#               Block reader
+# -------------------------------------------#
+
+
+class BlockReader:
+    """
+    Reads a band of a raster in windows aligned to the file's internal blocks.
+    Decoded blocks are kept in a `TileCache`, by default shared by all readers,
+    so neighbouring windows only decode each block once.
+    Other attributes such as `transform`, `crs` and `nodata` are taken from the dataset.
+    """
+    def __init__(
+            self,
+            dataset: rasterio.io.DatasetReader,
+            cache: TileCache = SHARED_TILE_CACHE,
+            band: int = 1,
+        ):
+        self.dataset = dataset
+        self.cache = cache
+        self.band = band
+        self.block_height, self.block_width = dataset.block_shapes[band - 1]
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def read_block(self, block_row: int, block_col: int) -> np.ndarray:
+        key = (self.dataset.name, self.band, block_row, block_col)
+        tile = self.cache.get(key)
+        if tile is None:
+            row_start = block_row * self.block_height
+            col_start = block_col * self.block_width
+            window = Window(
+                col_start,
+                row_start,
+                min(self.block_width, self.dataset.width - col_start),
+                min(self.block_height, self.dataset.height - row_start),
+            )
+            tile = self.dataset.read(self.band, window=window)
+            self.cache.put(key, tile)
+            profiling.count("raster.blocks_decoded")
+            profiling.count("raster.bytes_decoded", tile.nbytes)
+        return tile
+
+    def read(self, indexes: int = None, window: Window = None) -> np.ndarray:
+        """
+        Same as `DatasetReader.read` for this reader's band. The window must lie within the raster.
+        """
+        if indexes is not None and indexes != self.band:
+            raise Exception(f"BlockReader only reads band {self.band}, not {indexes}")
+        if window is None:
+            window = Window(0, 0, self.dataset.width, self.dataset.height)
+        window = window.round_offsets().round_lengths()
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+        if row_start < 0 or col_start < 0 or row_stop > self.dataset.height or col_stop > self.dataset.width:
+            raise Exception(f"Window {window} is outside the raster")
+        out = np.empty((row_stop - row_start, col_stop - col_start), dtype=self.dataset.dtypes[self.band - 1])
+        for block_row in range(row_start // self.block_height, (row_stop - 1) // self.block_height + 1):
+            tile_row_start = block_row * self.block_height
+            for block_col in range(col_start // self.block_width, (col_stop - 1) // self.block_width + 1):
+                tile_col_start = block_col * self.block_width
+                tile = self.read_block(block_row, block_col)
+                r0 = max(row_start, tile_row_start)
+                r1 = min(row_stop, tile_row_start + tile.shape[0])
+                c0 = max(col_start, tile_col_start)
+                c1 = min(col_stop, tile_col_start + tile.shape[1])
+                out[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    tile[r0 - tile_row_start:r1 - tile_row_start, c0 - tile_col_start:c1 - tile_col_start]
+        if indexes is None:
+            out = out[np.newaxis, :, :]
+        return out
+
+    def mask(self, shapes: List[Union[Polygon, MultiPolygon]]):
+        """
+        Same as `rasterio.mask.mask(dataset, shapes, crop=True)` for this reader's band.
+        Pixels outside the shapes are set to the nodata value, or 0 if there is none.
+        """
+        return mask_reader(self, shapes)
+
+
+def mask_reader(reader, shapes: List[Union[Polygon, MultiPolygon]]):
+    """
+    `rasterio.mask.mask(reader, shapes, crop=True)` for readers with the same `read` and `window_transform` methods.
+    """
+    try:
+        window = rasterio.features.geometry_window(reader, shapes)
+    except rasterio.errors.WindowError:
+        raise ValueError('Input shapes do not overlap raster.')
+    transform = reader.window_transform(window)
+    out_image = reader.read(window=window)
+    shape_mask = rasterio.features.geometry_mask(shapes, out_shape=out_image.shape[1:], transform=transform)
+    nodata = reader.nodata if reader.nodata is not None else 0
+    out_image[:, shape_mask] = nodata
+    return out_image, transform
+
+
+# -------------------------------------------#
+#          Memory-mapped raster store
+# -------------------------------------------#
+
+
+def get_store_filepaths(raster_filepath: str):
+    root, _ = os.path.splitext(raster_filepath)
+    return f"{root}.store.npy", f"{root}.store.json"
+
+
+class RasterStore:
+    """
+    One band of a raster stored uncompressed as a row-major memory-mapped .npy file, with a JSON sidecar holding
+    the transform, CRS, nodata value, data type, shape and the byte offset of the pixels in the file.
+    Any window is a view of the file, so processes reading the same store share one copy in the page cache
+    instead of each decompressing their own.
+    It has the attributes and `read`, `window_transform` and `mask` methods of a `DatasetReader` used by the utilities.
+    """
+    def __init__(self, filepath: str, meta_filepath: str):
+        with open(meta_filepath, 'r') as f:
+            meta = json.load(f)
+        self.name = filepath
+        self.array = np.load(filepath, mmap_mode='r')
+        self.transform = Affine(*meta["transform"])
+        self.crs = CRS.from_wkt(meta["crs"]) if meta["crs"] else None
+        self.nodata = meta["nodata"]
+        self.height, self.width = self.array.shape
+        self.count = 1
+        self.dtypes = (str(self.array.dtype),)
+        self.block_shapes = [(1, self.width)]
+        self.offset = meta["offset"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.array = None
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def bounds(self) -> BoundingBox:
+        return BoundingBox(*array_bounds(self.height, self.width, self.transform))
+
+    @property
+    def res(self):
+        return (abs(self.transform.a), abs(self.transform.e))
+
+    def window_transform(self, window: Window):
+        return rasterio.windows.transform(window, self.transform)
+
+    def view(self, window: Window = None) -> np.ndarray:
+        """
+        Read only view of a window of the store, without copying. The window must lie within the raster.
+        """
+        if window is None:
+            return self.array
+        window = window.round_offsets().round_lengths()
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+        if row_start < 0 or col_start < 0 or row_stop > self.height or col_stop > self.width:
+            raise Exception(f"Window {window} is outside the raster")
+        return self.array[row_start:row_stop, col_start:col_stop]
+
+    def read(self, indexes: int = None, window: Window = None) -> np.ndarray:
+        """
+        Same as `DatasetReader.read` for the stored band. Returns a writeable copy of the window
+        because the utilities modify what they read, e.g. to set nodata to 0. Use `view` to avoid the copy.
+        """
+        if indexes is not None and indexes != 1:
+            raise Exception(f"RasterStore only has band 1, not {indexes}")
+        out = np.array(self.view(window))
+        if indexes is None:
+            out = out[np.newaxis, :, :]
+        return out
+
+    def mask(self, shapes: List[Union[Polygon, MultiPolygon]]):
+        """
+        Same as `rasterio.mask.mask(dataset, shapes, crop=True)`.
+        """
+        return mask_reader(self, shapes)
+
+
+def convert_to_store(
+        raster_filepath: str,
+        filepath: str = None,
+        meta_filepath: str = None,
+        band: int = 1,
+        max_bytes: int = 256 * 2**20,
+    ) -> RasterStore:
+    """
+    Convert a band of a raster to a `RasterStore`, decompressing strips of rows bounded by `max_bytes`.
+    By default the store is saved next to the raster as `<name>.store.npy` and `<name>.store.json`.
+    The files are written to temporary paths first and then moved into place.
+    """
+    default_filepath, default_meta_filepath = get_store_filepaths(raster_filepath)
+    filepath = filepath or default_filepath
+    meta_filepath = meta_filepath or default_meta_filepath
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp.npy"
+    with rasterio.open(raster_filepath) as src:
+        dtype = np.dtype(src.dtypes[band - 1])
+        array = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=dtype, shape=(src.height, src.width))
+        strip_rows = max(1, max_bytes // (src.width * dtype.itemsize))
+        with profiling.stage("raster.convert_to_store", logger):
+            for row_start in range(0, src.height, strip_rows):
+                height = min(strip_rows, src.height - row_start)
+                array[row_start:row_start + height] = src.read(band, window=Window(0, row_start, src.width, height))
+        array.flush()
+        meta = {
+            "transform": list(src.transform)[:6],
+            "crs": src.crs.to_wkt() if src.crs else None,
+            "nodata": src.nodata,
+            "dtype": dtype.str,
+            "shape": [src.height, src.width],
+            "offset": array.offset,
+            "source": raster_filepath,
+        }
+    del array
+    os.replace(tmp_filepath, filepath)
+    tmp_meta_filepath = f"{meta_filepath}.{os.getpid()}.tmp"
+    with open(tmp_meta_filepath, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta_filepath, meta_filepath)
+    logger.info(f"Saved raster store to {filepath}")
+    return RasterStore(filepath, meta_filepath)
+
+
+def open_store(raster_filepath: str, **kwargs) -> RasterStore:
+    """
+    Open the store next to a raster, converting the raster first if the store is missing or older than the raster.
+    """
+    filepath, meta_filepath = get_store_filepaths(raster_filepath)
+    if os.path.isfile(meta_filepath) and os.path.getmtime(meta_filepath) >= os.path.getmtime(raster_filepath):
+        return RasterStore(filepath, meta_filepath)
+    return convert_to_store(raster_filepath, filepath, meta_filepath, **kwargs)
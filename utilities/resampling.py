@@ -0,0 +1,161 @@
+"""
+Count-preserving resampling of population rasters between grids with a sparse matrix.
+The matrix depends only on the source and destination grids, so it is built once and then applied
+to every raster on the same grid, e.g. each year of a WorldPop time series.
+"""
+import json
+import logging
+import numpy as np
+import rasterio.warp
+import scipy.interpolate
+import scipy.sparse
+from rasterio import Affine
+from rasterio.crs import CRS
+from rasterio.transform import array_bounds
+from rasterio.warp import calculate_default_transform
+from typing import Tuple
+
+from utilities import profiling
+from utilities.cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class ResamplingOperator:
+    """
+    Sparse matrix of shape (destination pixels, source pixels). Entry (i, j) is the fraction of the area of
+    source pixel j which lands in destination pixel i, so applying it moves counts without creating or losing any,
+    apart from source pixels which fall outside the destination grid.
+    """
+    def __init__(
+            self,
+            matrix: scipy.sparse.csr_matrix,
+            src_shape: Tuple[int, int],
+            dst_shape: Tuple[int, int],
+            dst_transform: Affine,
+            dst_crs,
+        ):
+        self.matrix = matrix
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        self.dst_transform = dst_transform
+        self.dst_crs = CRS.from_user_input(dst_crs)
+
+    def apply(self, values: np.ndarray, nodata: float = None) -> np.ndarray:
+        """
+        Resample a 2D raster of shape `src_shape`, or a stack of them of shape (n, height, width).
+        Nodata, negative and non-finite values count as 0.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        stacked = values.ndim == 3
+        if values.shape[-2:] != self.src_shape:
+            raise ValueError(f"Expected rasters of shape {self.src_shape}, got {values.shape[-2:]}")
+        columns = values.reshape(-1, self.src_shape[0] * self.src_shape[1]).T
+        invalid = ~np.isfinite(columns) | (columns < 0)
+        if nodata is not None:
+            invalid |= columns == nodata
+        columns = np.where(invalid, 0.0, columns)
+        with profiling.stage("resampling.apply", logger):
+            out = self.matrix @ columns
+        out = out.T.reshape(-1, *self.dst_shape)
+        return out if stacked else out[0]
+
+    def coverage(self) -> np.ndarray:
+        """
+        Fraction of each source pixel which lands inside the destination grid, with the source shape.
+        """
+        return np.asarray(self.matrix.sum(axis=0)).reshape(self.src_shape)
+
+    def save(self, filepath: str):
+        meta = {
+            "src_shape": list(self.src_shape),
+            "dst_shape": list(self.dst_shape),
+            "dst_transform": list(self.dst_transform)[:6],
+            "dst_crs": self.dst_crs.to_wkt(),
+        }
+        matrix = self.matrix
+        write_atomic(filepath, lambda f: np.savez(
+            f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, meta=json.dumps(meta)))
+
+    @classmethod
+    def load(cls, filepath: str):
+        with np.load(filepath) as data:
+            meta = json.loads(str(data["meta"]))
+            shape = (meta["dst_shape"][0] * meta["dst_shape"][1], meta["src_shape"][0] * meta["src_shape"][1])
+            matrix = scipy.sparse.csr_matrix((data["data"], data["indices"], data["indptr"]), shape=shape)
+        return cls(matrix, meta["src_shape"], meta["dst_shape"], Affine(*meta["dst_transform"]), meta["dst_crs"])
+
+
+def build_resampling_operator(
+        src_transform: Affine,
+        src_shape: Tuple[int, int],
+        src_crs,
+        dst_crs,
+        dst_transform: Affine = None,
+        dst_shape: Tuple[int, int] = None,
+        resolution: float = None,
+        supersample: int = 4,
+        lattice_step: int = 8,
+        max_points: int = 2**22,
+    ) -> ResamplingOperator:
+    """
+    Area weighted resampling operator from a source grid to a destination grid.
+    Without `dst_transform` and `dst_shape`, the destination grid is the default transform of the source bounds,
+    as in `projection.reproject_image`.
+    Each source pixel is split into `supersample` x `supersample` sub-pixels whose centres are projected into the
+    destination grid, so the weights are accurate to about 1/supersample of a pixel along the edges.
+    Like GDAL's approximate transformer, only a lattice of points every `lattice_step` source pixels is projected
+    exactly and the sub-pixel centres are linearly interpolated between them. Set it to None to project every sub-pixel.
+    Source rows are processed in strips of at most `max_points` sub-pixels.
+    """
+    src_height, src_width = src_shape
+    if dst_transform is None or dst_shape is None:
+        bounds = array_bounds(src_height, src_width, src_transform)
+        dst_transform, dst_width, dst_height = calculate_default_transform(
+            src_crs, dst_crs, src_width, src_height, *bounds, resolution=resolution)
+        dst_shape = (dst_height, dst_width)
+    dst_height, dst_width = dst_shape
+    num_src = src_height * src_width
+    offsets = (np.arange(supersample) + 0.5) / supersample
+    sub_cols = (np.arange(src_width)[:, np.newaxis] + offsets).ravel()
+    a, b, c, d, e, f = src_transform[:6]
+    inverse = ~dst_transform
+
+    def project(rows: np.ndarray, cols: np.ndarray):
+        xs, ys = rasterio.warp.transform(src_crs, dst_crs, a * cols + b * rows + c, d * cols + e * rows + f)
+        return np.asarray(xs), np.asarray(ys)
+
+    if lattice_step:
+        lattice_rows = np.unique(np.append(np.arange(0, src_height, lattice_step), src_height)).astype(np.float64)
+        lattice_cols = np.unique(np.append(np.arange(0, src_width, lattice_step), src_width)).astype(np.float64)
+        grid_rows, grid_cols = np.meshgrid(lattice_rows, lattice_cols, indexing='ij')
+        lattice_xs, lattice_ys = project(grid_rows.ravel(), grid_cols.ravel())
+        interpolate_x = scipy.interpolate.RegularGridInterpolator(
+            (lattice_rows, lattice_cols), lattice_xs.reshape(grid_rows.shape))
+        interpolate_y = scipy.interpolate.RegularGridInterpolator(
+            (lattice_rows, lattice_cols), lattice_ys.reshape(grid_rows.shape))
+        project = lambda rows, cols: (interpolate_x((rows, cols)), interpolate_y((rows, cols)))
+    strip_rows = max(1, max_points // (src_width * supersample**2))
+    keys, counts = [], []
+    with profiling.stage("resampling.build", logger):
+        for row_start in range(0, src_height, strip_rows):
+            rows = np.arange(row_start, min(row_start + strip_rows, src_height))
+            sub_rows = (rows[:, np.newaxis] + offsets).ravel()
+            rr, cc = np.meshgrid(sub_rows, sub_cols, indexing='ij')
+            rr, cc = rr.ravel(), cc.ravel()
+            xs, ys = project(rr, cc)
+            dst_cols = np.floor(inverse.a * xs + inverse.b * ys + inverse.c).astype(np.int64)
+            dst_rows = np.floor(inverse.d * xs + inverse.e * ys + inverse.f).astype(np.int64)
+            inside = (dst_cols >= 0) & (dst_cols < dst_width) & (dst_rows >= 0) & (dst_rows < dst_height)
+            src_index = rr.astype(np.int64) * src_width + cc.astype(np.int64)
+            dst_index = dst_rows * dst_width + dst_cols
+            strip_keys, strip_counts = np.unique(dst_index[inside] * num_src + src_index[inside], return_counts=True)
+            keys.append(strip_keys)
+            counts.append(strip_counts)
+            profiling.count("resampling.points_projected", len(rr))
+    keys = np.concatenate(keys)
+    weights = np.concatenate(counts) / supersample**2
+    matrix = scipy.sparse.csr_matrix(
+        (weights, (keys // num_src, keys % num_src)), shape=(dst_height * dst_width, num_src))
+    logger.debug(f"Resampling operator with {matrix.nnz} entries from {src_shape} to {dst_shape}")
+    return ResamplingOperator(matrix, src_shape, dst_shape, dst_transform, dst_crs)
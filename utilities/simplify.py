@@ -0,0 +1,294 @@
+"""
+Levels of detail of administrative areas for masking, plotting and intersections at coarse resolutions.
+Level 0 is the original geometries and each later level is simplified with a larger tolerance, in the units of the
+geometries (degrees for geoBoundaries). Shared borders are simplified once with `shapely.coverage_simplify`
+so neighbouring areas stay gap and overlap free. For each level the Hausdorff distance to the original, the displaced
+area and, given a raster, the change in population of every geometry are recorded, so that a level can be chosen
+by the error it introduces rather than by its tolerance.
+"""
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import rasterio
+import shapely
+from shapely import MultiPolygon, Polygon
+from typing import Dict, List, Tuple, Union
+
+from utilities import profiling
+from utilities.area import EARTH_RADIUS, calc_geometry_areas
+from utilities.cache import DEFAULT_CACHE_DIR, file_checksum, hash_key, load_geometries, save_geometries, write_atomic
+from utilities.zonal import ZoneWeights
+
+logger = logging.getLogger(__name__)
+
+
+def get_level_tolerances(resolution: float, num_levels: int = 8, fraction: float = 0.125) -> List[float]:
+    """
+    Tolerances of `fraction` of a pixel of size `resolution` doubling at each level, after 0 for the original level.
+    The defaults go from 1/8 of a pixel to 8 pixels.
+    """
+    return [0.0] + [resolution * fraction * 2**level for level in range(num_levels - 1)]
+
+
+def get_raster_tolerance(resolution: float, fraction: float = 0.5) -> float:
+    """
+    Largest distance the borders may move for masking a raster with pixels of size `resolution`.
+    A border moved by less than `fraction` of a pixel only changes which pixel centres are inside along the border.
+    """
+    return resolution * fraction
+
+
+def get_figure_tolerance(bounds: Tuple[float, float, float, float], figsize: Tuple[float, float], dpi: float = 100, pixels: float = 0.5) -> float:
+    """
+    Largest distance the borders may move for drawing geometries spanning `bounds` (left, bottom, right, top)
+    on a figure of `figsize` inches, so that they move by at most `pixels` screen pixels.
+    """
+    left, bottom, right, top = bounds
+    units_per_pixel = max((right - left) / (figsize[0] * dpi), (top - bottom) / (figsize[1] * dpi))
+    return units_per_pixel * pixels
+
+
+def simplify_geometries(geometries: List[Union[Polygon, MultiPolygon]], tolerance: float) -> np.ndarray:
+    """
+    Topology preserving simplification. A valid coverage is simplified with `shapely.coverage_simplify` (GEOS 3.12+).
+    Otherwise, or with older versions, each geometry is simplified separately with `preserve_topology=True`,
+    which keeps every geometry valid but may open small gaps or overlaps between neighbours.
+    Only the latter treats `tolerance` as a distance. For `coverage_simplify` it is roughly the square root of the
+    area of the triangles removed (Visvalingam-Whyatt), so long thin spikes can go at small tolerances.
+    """
+    geometries = np.asarray(list(geometries), dtype=object)
+    if tolerance <= 0:
+        return geometries
+    if hasattr(shapely, 'coverage_simplify') and shapely.coverage_is_valid(geometries):
+        simplified = shapely.coverage_simplify(geometries, tolerance)
+    else:
+        simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    invalid = ~shapely.is_valid(simplified)
+    if invalid.any():
+        simplified[invalid] = shapely.make_valid(simplified[invalid])
+    return simplified
+
+
+class GeometryLevels:
+    """
+    Geometries simplified at increasing tolerances, with the error of each level relative to level 0.
+    `distances[level]` is the Hausdorff distance of each geometry to its original, `area_errors[level]` the displaced (symmetric difference) area of each geometry over its area, and
+    `population_errors[level]` the absolute change in population over the population, or None without a raster.
+    """
+    def __init__(
+            self,
+            names: List[str],
+            levels: List[np.ndarray],
+            tolerances: List[float],
+            distances: np.ndarray,
+            area_errors: np.ndarray,
+            population_errors: np.ndarray = None,
+        ):
+        self.names = list(names)
+        self.levels = levels
+        self.tolerances = list(tolerances)
+        self.distances = np.asarray(distances)
+        self.area_errors = np.asarray(area_errors)
+        self.population_errors = None if population_errors is None else np.asarray(population_errors)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def get(self, level: int) -> Dict[str, Union[Polygon, MultiPolygon]]:
+        return dict(zip(self.names, self.levels[level]))
+
+    def choose_level(self, max_distance: float, max_area_error: float = None, max_population_error: float = None) -> int:
+        """
+        Coarsest level where no geometry has moved by more than `max_distance` or exceeds the given relative errors.
+        Level 0 is always allowed.
+        """
+        chosen = 0
+        for level in range(1, len(self.levels)):
+            if self.distances[level].max(initial=0) > max_distance:
+                break
+            if max_area_error is not None and self.area_errors[level].max(initial=0) > max_area_error:
+                break
+            if max_population_error is not None:
+                if self.population_errors is None:
+                    raise ValueError("Population errors were not computed for these levels")
+                if self.population_errors[level].max(initial=0) > max_population_error:
+                    break
+            chosen = level
+        return chosen
+
+    def for_raster(
+            self,
+            resolution: float,
+            fraction: float = 0.5,
+            max_area_error: float = 0.01,
+            max_population_error: float = 0.01,
+        ):
+        """
+        Geometries for masking a raster with pixels of size `resolution`, e.g. `abs(population_data.res[0])`.
+        The population error limit only applies if the levels were built with a raster.
+        """
+        if self.population_errors is None:
+            max_population_error = None
+        level = self.choose_level(
+            get_raster_tolerance(resolution, fraction), max_area_error=max_area_error, max_population_error=max_population_error)
+        logger.debug(f"Using level {level} with tolerance {self.tolerances[level]:g} for resolution {resolution:g}")
+        return self.get(level)
+
+    def for_figure(
+            self,
+            bounds: Tuple[float, float, float, float],
+            figsize: Tuple[float, float],
+            dpi: float = 100,
+            pixels: float = 0.5,
+            max_area_error: float = 0.01,
+        ):
+        """
+        Geometries for drawing the area within `bounds` on a figure of `figsize` inches.
+        """
+        level = self.choose_level(get_figure_tolerance(bounds, figsize, dpi, pixels), max_area_error=max_area_error)
+        logger.debug(f"Using level {level} with tolerance {self.tolerances[level]:g} for a {figsize} figure")
+        return self.get(level)
+
+    def summary(self) -> List[dict]:
+        """
+        Tolerance, vertex count and the maximum and total errors of every level.
+        """
+        rows = []
+        for level, geometries in enumerate(self.levels):
+            row = {
+                "level": level,
+                "tolerance": self.tolerances[level],
+                "vertices": int(shapely.get_num_coordinates(geometries).sum()),
+                "max_distance": float(self.distances[level].max(initial=0)),
+                "max_area_error": float(self.area_errors[level].max(initial=0)),
+            }
+            if self.population_errors is not None:
+                row["max_population_error"] = float(self.population_errors[level].max(initial=0))
+            rows.append(row)
+        return rows
+
+
+def calc_area_errors(
+        original: np.ndarray,
+        simplified: np.ndarray,
+        areas: np.ndarray,
+        radius: float = EARTH_RADIUS,
+    ) -> np.ndarray:
+    """
+    Area on a sphere of the symmetric difference between each original and simplified geometry over the original area.
+    """
+    difference = shapely.symmetric_difference(original, simplified)
+    difference = np.array([
+        geom if isinstance(geom, (Polygon, MultiPolygon)) else MultiPolygon(
+            [part for part in getattr(geom, 'geoms', []) if isinstance(part, Polygon)])
+        for geom in difference
+    ], dtype=object)
+    difference_areas = calc_geometry_areas(difference, radius=radius)
+    return np.divide(difference_areas, areas, out=np.zeros_like(difference_areas), where=areas > 0)
+
+
+def calc_population_errors(
+        population_data: rasterio.io.DatasetReader,
+        original_populations: np.ndarray,
+        simplified: np.ndarray,
+    ) -> np.ndarray:
+    """
+    Change in population of each geometry over its original population, with at least 1 person as the denominator.
+    """
+    populations, _, _ = ZoneWeights.from_shapes(population_data, simplified).zonal_stats(population_data)
+    return np.abs(populations - original_populations) / np.maximum(original_populations, 1)
+
+
+def build_geometry_levels(
+        shapes: Dict[str, Union[Polygon, MultiPolygon]],
+        tolerances: List[float],
+        population_data: rasterio.io.DatasetReader = None,
+        radius: float = EARTH_RADIUS,
+    ) -> GeometryLevels:
+    """
+    Simplify the shapes at each of the `tolerances`, starting with 0, and measure the errors of every level.
+    Distances are in the units of the shapes and areas are on a sphere.
+    Population errors are only computed if `population_data` is given, with pixel centres inside each geometry
+    as in `rasterio.mask.mask`.
+    """
+    if not tolerances or tolerances[0] != 0:
+        tolerances = [0.0] + list(tolerances)
+    original = np.asarray(list(shapes.values()), dtype=object)
+    levels, distances, area_errors, population_errors = [], [], [], []
+    with profiling.stage("simplify.build_geometry_levels", logger):
+        areas = calc_geometry_areas(original, radius=radius)
+        if population_data is not None:
+            original_populations, _, _ = ZoneWeights.from_shapes(population_data, original).zonal_stats(population_data)
+        for tolerance in tolerances:
+            simplified = simplify_geometries(original, tolerance)
+            levels.append(simplified)
+            if tolerance == 0:
+                distances.append(np.zeros(len(original)))
+                area_errors.append(np.zeros(len(original)))
+                population_errors.append(np.zeros(len(original)))
+                continue
+            # empty geometries have a NaN distance
+            distances.append(np.nan_to_num(shapely.hausdorff_distance(original, simplified)))
+            area_errors.append(calc_area_errors(original, simplified, areas, radius=radius))
+            if population_data is not None:
+                population_errors.append(calc_population_errors(population_data, original_populations, simplified))
+    profiling.count("simplify.levels", len(levels))
+    return GeometryLevels(
+        list(shapes.keys()), levels, tolerances, np.stack(distances), np.stack(area_errors),
+        np.stack(population_errors) if population_data is not None else None,
+    )
+
+
+def get_geometry_levels_cached(
+        shapes: Dict[str, Union[Polygon, MultiPolygon]],
+        tolerances: List[float],
+        raster_filepath: str = None,
+        radius: float = EARTH_RADIUS,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+    ) -> GeometryLevels:
+    """
+    Same as `build_geometry_levels` with the levels saved as WKB and the errors in a JSON file.
+    The cache is keyed by the WKB of the shapes, the tolerances and the checksum of the raster used for
+    the population errors, if any.
+    """
+    wkb = shapely.to_wkb(np.asarray(list(shapes.values()), dtype=object))
+    geometries_key = hashlib.sha256(b''.join(wkb) + '\0'.join(shapes.keys()).encode('utf-8')).hexdigest()
+    key = hash_key({
+        "geometries": geometries_key,
+        "tolerances": [float(tolerance) for tolerance in tolerances],
+        "raster": file_checksum(raster_filepath, cache_dir=cache_dir) if raster_filepath else None,
+        "radius": radius,
+    })
+    directory = os.path.join(cache_dir, 'levels', key)
+    meta_filepath = os.path.join(directory, 'levels.json')
+    if os.path.isfile(meta_filepath):
+        logger.info(f"Loading cached geometry levels from {directory}")
+        with open(meta_filepath, 'r') as f:
+            meta = json.load(f)
+        levels = [
+            np.asarray(list(load_geometries(os.path.join(directory, f"level{level}.npz")).values()), dtype=object)
+            for level in range(len(meta["tolerances"]))
+        ]
+        return GeometryLevels(
+            meta["names"], levels, meta["tolerances"], meta["distances"], meta["area_errors"], meta["population_errors"])
+    if raster_filepath:
+        with rasterio.open(raster_filepath) as src:
+            geometry_levels = build_geometry_levels(shapes, tolerances, population_data=src, radius=radius)
+    else:
+        geometry_levels = build_geometry_levels(shapes, tolerances, radius=radius)
+    for level in range(len(geometry_levels)):
+        save_geometries(os.path.join(directory, f"level{level}.npz"), geometry_levels.get(level))
+    population_errors = geometry_levels.population_errors
+    meta = {
+        "names": geometry_levels.names,
+        "tolerances": geometry_levels.tolerances,
+        "distances": geometry_levels.distances.tolist(),
+        "area_errors": geometry_levels.area_errors.tolist(),
+        "population_errors": None if population_errors is None else population_errors.tolist(),
+    }
+    # the JSON file is written last and marks the levels as complete
+    write_atomic(meta_filepath, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    logger.info(f"Saved {len(geometry_levels)} geometry levels to {directory}")
+    return geometry_levels
@@ -0,0 +1,106 @@
+import logging
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+from shapely import Point, Polygon
+
+from utilities.area import haversine_formula, EARTH_AUTHALIC_RADIUS
+from utilities.geojson import gather_coordinates, convert_dict_to_shapely
+
+logger = logging.getLogger(__name__)
+
+
+def to_unit_sphere(longitudes: np.ndarray, latitudes: np.ndarray):
+    """
+    Convert longitudes and latitudes in degrees to (x, y, z) points on the unit sphere.
+    """
+    longs = np.deg2rad(np.asarray(longitudes, dtype=float))
+    lats = np.deg2rad(np.asarray(latitudes, dtype=float))
+    xyz = np.stack([np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)], axis=-1)
+    return xyz
+
+
+class FeatureIndex:
+    """
+    Spatial index over the features of a GeoJSON FeatureCollection for repeated queries.
+    The envelopes of the features are stored in an STRtree and the vertices in a k-d tree on the unit sphere.
+    As with the `filter_features_by_*` functions, only the exterior vertices are used and holes are ignored.
+    """
+    def __init__(self, shape_data: dict, earth_radius: float = EARTH_AUTHALIC_RADIUS):
+        self.features = shape_data['features']
+        self.earth_radius = earth_radius
+        self.coords, self.offsets = gather_coordinates(self.features)
+        lengths = np.diff(self.offsets)
+        self.feature_ids = np.repeat(np.arange(len(self.features)), lengths)
+        # envelopes
+        non_empty = lengths > 0
+        starts = self.offsets[:-1][non_empty]
+        envelopes = np.full(len(self.features), None, dtype=object)
+        if len(starts):
+            mins = np.minimum.reduceat(self.coords, starts, axis=0)
+            maxs = np.maximum.reduceat(self.coords, starts, axis=0)
+            envelopes[non_empty] = shapely.box(mins[:, 0], mins[:, 1], maxs[:, 0], maxs[:, 1])
+        self.envelopes = envelopes
+        self.envelope_tree = shapely.STRtree(envelopes)
+        self.vertex_tree = cKDTree(to_unit_sphere(self.coords[:, 0], self.coords[:, 1]))
+        logger.info(f"Indexed {len(self.features)} features with {len(self.coords)} vertices.")
+
+    def __len__(self):
+        return len(self.features)
+
+    def _select(self, feature_idxs: np.ndarray):
+        return [self.features[idx] for idx in np.unique(feature_idxs)]
+
+    def within_bounds(self, boundary: Polygon):
+        """
+        Return features that fit entirely within the boundary. Same as `filter_features_by_bounds`.
+        """
+        candidates = self.envelope_tree.query(shapely.box(*boundary.bounds), predicate='contains')
+        if len(candidates) == 0:
+            return []
+        candidates = np.sort(candidates)
+        vertex_idxs = np.concatenate([
+            np.arange(self.offsets[idx], self.offsets[idx + 1]) for idx in candidates
+        ])
+        shapely.prepare(boundary)
+        inside = shapely.contains_xy(boundary, self.coords[vertex_idxs, 0], self.coords[vertex_idxs, 1])
+        num_outside = np.bincount(self.feature_ids[vertex_idxs][~inside], minlength=len(self.features))
+        valid = candidates[num_outside[candidates] == 0]
+        return self._select(valid)
+
+    def within_distance(self, point: tuple, great_circle_distance: float):
+        """
+        Return features where at least one point falls within the `great_circle_distance` in metres.
+        Same as `filter_features_by_proximity`.
+        """
+        theta = min(great_circle_distance / self.earth_radius, np.pi)
+        chord = 2 * np.sin(theta / 2) * (1 + 1e-9)
+        vertex_idxs = np.asarray(self.vertex_tree.query_ball_point(to_unit_sphere(*point), chord), dtype=np.int64)
+        # exact check so that results match the haversine formula
+        long1, lat1 = np.deg2rad(self.coords[vertex_idxs].T)
+        distances = self.earth_radius * haversine_formula(long1, lat1, np.deg2rad(point[0]), np.deg2rad(point[1]))
+        return self._select(self.feature_ids[vertex_idxs[distances <= great_circle_distance]])
+
+    def nearest(self, point: tuple, k: int = 1):
+        """
+        Return the `k` features nearest to the point, ordered by distance.
+        Features which contain the point come first. The rest are ordered by their nearest vertex.
+        """
+        nearest_idxs = []
+        for idx in self.envelope_tree.query(Point(*point), predicate='intersects'):
+            polygon = convert_dict_to_shapely(self.features[idx]['geometry'])
+            if polygon.contains(Point(*point)):
+                nearest_idxs.append(idx)
+        num_vertices = len(self.coords)
+        num_neighbours = min(4 * k, num_vertices)
+        xyz = to_unit_sphere(*point)
+        while len(nearest_idxs) < k and num_neighbours > 0:
+            _, vertex_idxs = self.vertex_tree.query(xyz, k=num_neighbours)
+            vertex_idxs = np.atleast_1d(vertex_idxs)
+            for idx in self.feature_ids[vertex_idxs]:
+                if idx not in nearest_idxs:
+                    nearest_idxs.append(idx)
+            if num_neighbours == num_vertices:
+                break
+            num_neighbours = min(4 * num_neighbours, num_vertices)
+        return [self.features[idx] for idx in nearest_idxs[:k]]
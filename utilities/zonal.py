@@ -0,0 +1,309 @@
+import logging
+import numpy as np
+import rasterio
+import rasterio.errors
+import rasterio.features
+import rasterio.windows
+import scipy.sparse
+import shapely
+from rasterio.windows import Window
+from shapely import MultiPolygon, Polygon
+from typing import List, Union
+
+from utilities import profiling
+from utilities.area import EARTH_RADIUS, calc_geometry_areas
+from utilities.raster import BlockReader, RasterStore
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------#
+#          Label raster zonal statistics
+# -------------------------------------------#
+
+
+def rasterize_labels(shapes: List[Union[Polygon, MultiPolygon]], out_shape: tuple, transform):
+    """
+    Burn the index of each shape into a single label raster.
+    Shape `idx` is labelled `idx + 1` and 0 is the background.
+    A pixel belongs to a shape if its centre lies inside it, as with `rasterio.mask.mask`.
+    Shapes are assumed not to overlap. Where they do the later shape gets the pixel.
+    """
+    labels = rasterio.features.rasterize(
+        ((shape, idx + 1) for idx, shape in enumerate(shapes) if not shape.is_empty),
+        out_shape=out_shape,
+        transform=transform,
+        fill=0,
+        dtype='int32',
+    )
+    return labels
+
+
+def reduce_labels(labels: np.ndarray, values: np.ndarray, num_zones: int):
+    """
+    Per zone sum, maximum and pixel count of `values` for a label raster from `rasterize_labels`.
+    """
+    labels = labels.ravel()
+    inside = labels > 0
+    zones = labels[inside] - 1
+    zone_values = values.ravel()[inside].astype(np.float64)
+    sums = np.bincount(zones, weights=zone_values, minlength=num_zones)
+    counts = np.bincount(zones, minlength=num_zones)
+    maxs = np.zeros(num_zones)
+    np.maximum.at(maxs, zones, zone_values)
+    return sums, maxs, counts
+
+
+def get_shapes_window(population_data: rasterio.io.DatasetReader, shapes: List[Union[Polygon, MultiPolygon]]) -> Window:
+    """
+    Same as `rasterio.features.geometry_window` over the non-empty shapes.
+    Raises a `WindowError` if they are all empty or none of them overlap the raster.
+    """
+    shapes = [shape for shape in shapes if not shape.is_empty]
+    if not shapes:
+        raise rasterio.errors.WindowError("All shapes are empty.")
+    return rasterio.features.geometry_window(population_data, shapes)
+
+
+def zonal_stats(
+        population_data: rasterio.io.DatasetReader,
+        shapes: List[Union[Polygon, MultiPolygon]],
+    ):
+    """
+    Population sum, maximum pixel value and pixel count for every shape.
+    The raster is read once over the window covering all the shapes.
+    Negative (nodata) pixels are counted as 0. Empty shapes get 0 for all three.
+    """
+    shapes = list(shapes)
+    n = len(shapes)
+    try:
+        window = get_shapes_window(population_data, shapes)
+    except rasterio.errors.WindowError as e:
+        logger.warning(f"{e} Setting population counts to 0.")
+        return np.zeros(n), np.zeros(n), np.zeros(n, dtype=int)
+    transform = population_data.window_transform(window)
+    with profiling.stage("zonal.read", logger):
+        img = population_data.read(1, window=window)
+        img[img < 0] = 0
+    profiling.count("raster.pixels_read", img.size)
+    if not isinstance(population_data, (BlockReader, RasterStore)):
+        profiling.count("raster.bytes_decoded", img.nbytes)
+    with profiling.stage("zonal.rasterize", logger):
+        labels = rasterize_labels(shapes, img.shape, transform)
+    with profiling.stage("zonal.reduce", logger):
+        stats = reduce_labels(labels, img, n)
+    profiling.count("zonal.polygons", n)
+    return stats
+
+
+def get_density_per_area_zonal(
+        population_data: rasterio.io.DatasetReader,
+        shapes: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS
+    ):
+    """
+    Single read alternative to `get_density_per_area` with the same outputs.
+    Suitable for sets of non-overlapping shapes such as administrative units.
+    """
+    shapes = list(shapes)
+    for shape in shapes:
+        if not isinstance(shape, (Polygon, MultiPolygon)):
+            type_ = type(shape)
+            raise Exception(f"type {type_} is not supported")
+    areas = calc_geometry_areas(shapes, radius=radius, holes=False) # metres^2
+    population_counts, _, _ = zonal_stats(population_data, shapes)
+    densities = population_counts / (areas/1e6) # convert to km2
+    return densities, population_counts, areas
+
+
+# -------------------------------------------#
+#          Reusable zone weights
+# -------------------------------------------#
+
+
+class ZoneWeights:
+    """
+    Pixels covered by each zone, built once from a set of shapes and a raster grid and reused for every raster
+    on the same grid, e.g. several WorldPop years or products.
+    The pixels are flat indices into `window`, the window covering all the shapes, with a weight for each.
+    Zones may overlap.
+    """
+    def __init__(
+            self,
+            zones: np.ndarray,
+            pixels: np.ndarray,
+            weights: np.ndarray,
+            num_zones: int,
+            window: Window,
+            transform,
+            raster_shape: tuple,
+        ):
+        self.zones = zones
+        self.pixels = pixels
+        self.weights = weights
+        self.num_zones = num_zones
+        self.window = window
+        self.transform = transform
+        self.raster_shape = raster_shape
+        if window is None:
+            window_size = 0
+        else:
+            window_size = int(window.height) * int(window.width)
+        self.matrix = scipy.sparse.csr_matrix((weights, (zones, pixels)), shape=(num_zones, window_size))
+
+    @classmethod
+    def from_shapes(
+            cls,
+            population_data: rasterio.io.DatasetReader,
+            shapes: List[Union[Polygon, MultiPolygon]],
+            fractional: bool = False,
+        ):
+        """
+        Without `fractional`, a pixel belongs to a shape if its centre lies inside it with a weight of 1,
+        as with `rasterio.mask.mask` and `zonal_stats`.
+        With `fractional`, every pixel the shape touches is weighted by the fraction of its area inside the shape,
+        computed in the raster's coordinates for pixels on the shape's boundary.
+        """
+        shapes = list(shapes)
+        num_zones = len(shapes)
+        raster_shape = (population_data.height, population_data.width)
+        try:
+            window = get_shapes_window(population_data, shapes)
+        except rasterio.errors.WindowError as e:
+            logger.warning(f"{e} All zones are empty.")
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, np.zeros(0), num_zones, None, population_data.transform, raster_shape)
+        window_transform = population_data.window_transform(window)
+        height, width = int(window.height), int(window.width)
+        zones, pixels, weights = [], [], []
+        with profiling.stage("zonal.zone_weights", logger):
+            for idx, shape in enumerate(shapes):
+                if shape.is_empty:
+                    continue
+                shape_pixels, shape_weights = _get_shape_pixels(shape, window_transform, height, width, fractional)
+                zones.append(np.full(len(shape_pixels), idx, dtype=np.int64))
+                pixels.append(shape_pixels)
+                weights.append(shape_weights)
+        zones = np.concatenate(zones) if zones else np.zeros(0, dtype=np.int64)
+        pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate(weights) if weights else np.zeros(0)
+        profiling.count("zonal.polygons", num_zones)
+        return cls(zones, pixels, weights, num_zones, window, population_data.transform, raster_shape)
+
+    def check_grid(self, population_data: rasterio.io.DatasetReader):
+        if (population_data.height, population_data.width) != self.raster_shape \
+                or not population_data.transform.almost_equals(self.transform):
+            raise ValueError(f"Raster {population_data.name} is not on the grid of the zone weights")
+
+    def read(self, population_data: rasterio.io.DatasetReader) -> np.ndarray:
+        """
+        Read the window of the zones from a raster on the same grid. Negative (nodata) pixels are set to 0.
+        """
+        self.check_grid(population_data)
+        with profiling.stage("zonal.read", logger):
+            img = population_data.read(1, window=self.window)
+            img[img < 0] = 0
+        profiling.count("raster.pixels_read", img.size)
+        if not isinstance(population_data, (BlockReader, RasterStore)):
+            profiling.count("raster.bytes_decoded", img.nbytes)
+        return img
+
+    def reduce(self, values: np.ndarray) -> np.ndarray:
+        """
+        Weighted per zone sums of an image of the window, or of a stack of them with shape (n, height, width).
+        Returns an array of shape (num_zones,) or (n, num_zones).
+        """
+        values = np.asarray(values)
+        flat = values.reshape(-1, self.matrix.shape[1]).astype(np.float64)
+        sums = (self.matrix @ flat.T).T
+        return sums if values.ndim == 3 else sums[0]
+
+    def counts(self) -> np.ndarray:
+        """
+        Weighted number of pixels in each zone.
+        """
+        return np.bincount(self.zones, weights=self.weights, minlength=self.num_zones)
+
+    def zonal_stats(self, population_data: rasterio.io.DatasetReader):
+        """
+        Same outputs as `zonal_stats`: the population sum, maximum pixel value and pixel count for every zone.
+        With fractional weights the count is fractional and the maximum is over all touched pixels.
+        """
+        if self.window is None:
+            n = self.num_zones
+            return np.zeros(n), np.zeros(n), np.zeros(n)
+        img = self.read(population_data)
+        with profiling.stage("zonal.reduce", logger):
+            sums = self.reduce(img)
+            maxs = np.zeros(self.num_zones)
+            np.maximum.at(maxs, self.zones, img.ravel()[self.pixels].astype(np.float64))
+        return sums, maxs, self.counts()
+
+    def reduce_rasters(self, rasters: List[rasterio.io.DatasetReader]) -> np.ndarray:
+        """
+        Per zone population sums of several rasters on the same grid, with one read of the window per raster.
+        Returns an array of shape (len(rasters), num_zones).
+        """
+        if self.window is None:
+            return np.zeros((len(rasters), self.num_zones))
+        return np.stack([self.reduce(self.read(population_data)) for population_data in rasters])
+
+
+def _get_shape_pixels(shape: Union[Polygon, MultiPolygon], transform, height: int, width: int, fractional: bool):
+    """
+    Flat pixel indices and weights of a shape in an image of `height` x `width` pixels.
+    The shape is rasterized over its own bounds only.
+    """
+    sub_window = rasterio.windows.from_bounds(*shape.bounds, transform=transform)
+    row_start = max(0, int(np.floor(sub_window.row_off)))
+    col_start = max(0, int(np.floor(sub_window.col_off)))
+    row_stop = min(height, int(np.ceil(sub_window.row_off + sub_window.height)))
+    col_stop = min(width, int(np.ceil(sub_window.col_off + sub_window.width)))
+    if row_start >= row_stop or col_start >= col_stop:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    sub_window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    sub_transform = rasterio.windows.transform(sub_window, transform)
+    out_shape = (row_stop - row_start, col_stop - col_start)
+    mask = rasterio.features.rasterize(
+        [(shape, 1)], out_shape=out_shape, transform=sub_transform, fill=0, dtype='uint8', all_touched=fractional)
+    weights = np.ones(out_shape)
+    if fractional:
+        edges = rasterio.features.rasterize(
+            [(shape.boundary, 1)], out_shape=out_shape, transform=sub_transform, fill=0, dtype='uint8', all_touched=True)
+        rows, cols = np.nonzero(edges & mask)
+        xs0, ys0 = _apply(sub_transform, cols, rows)
+        xs1, ys1 = _apply(sub_transform, cols + 1, rows + 1)
+        boxes = shapely.box(np.minimum(xs0, xs1), np.minimum(ys0, ys1), np.maximum(xs0, xs1), np.maximum(ys0, ys1))
+        weights[rows, cols] = shapely.area(shapely.intersection(boxes, shape)) / shapely.area(boxes)
+        mask &= weights > 0
+    rows, cols = np.nonzero(mask)
+    pixels = (rows + row_start).astype(np.int64) * width + (cols + col_start)
+    return pixels, weights[rows, cols]
+
+
+def _apply(transform, cols: np.ndarray, rows: np.ndarray):
+    a, b, c, d, e, f = transform[:6]
+    return a * cols + b * rows + c, d * cols + e * rows + f
+
+
+def get_density_per_area_rasters(
+        rasters: List[rasterio.io.DatasetReader],
+        shapes: List[Union[Polygon, MultiPolygon]],
+        radius: float = EARTH_RADIUS,
+        fractional: bool = False,
+    ):
+    """
+    Densities, population counts and areas of the shapes for several rasters on the same grid,
+    such as the WorldPop years of one country. The zone weights are built once from the first raster's grid
+    and each raster is read once. Densities and population counts have shape (len(rasters), len(shapes)).
+    """
+    shapes = list(shapes)
+    for shape in shapes:
+        if not isinstance(shape, (Polygon, MultiPolygon)):
+            type_ = type(shape)
+            raise Exception(f"type {type_} is not supported")
+    areas = calc_geometry_areas(shapes, radius=radius, holes=False) # metres^2
+    zone_weights = ZoneWeights.from_shapes(rasters[0], shapes, fractional=fractional)
+    population_counts = zone_weights.reduce_rasters(rasters)
+    densities = population_counts / (areas/1e6) # convert to km2
+    return densities, population_counts, areas